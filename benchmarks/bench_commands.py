@@ -0,0 +1,88 @@
+"""Measures the latency of the !list and !del commands against the total
+number of searches.
+
+Adds searches spread over many channels and times building the list embed
+of a channel and deleting searches from it. Sending the embeds, updating
+the bot's presence and writing to the storage are left out, only the work
+done on the event loop by the search index is measured.
+Needs the requirements of the bot.
+
+Usage: python benchmarks/bench_commands.py [searches ...]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+import bot  # noqa: E402
+import data  # noqa: E402
+import ebay  # noqa: E402
+import usage  # noqa: E402
+
+from bench_search_memory import random_url  # noqa: E402
+
+
+CHANNELS = 5000
+RUNS = 200
+
+
+class Channel:
+    def __init__(self, id):
+        self.id = id
+
+
+async def no_presence():
+    pass
+
+
+def reset():
+    ebay.search_list.clear()
+    ebay.channel_searches.clear()
+    ebay.query_list.clear()
+    ebay.batch_list.clear()
+    ebay.batch_groups.clear()
+    ebay.total_search_cost = 0
+
+
+async def measure(count, rng):
+    reset()
+    for n in range(count):
+        search = ebay.Search(random_url(rng), 700000000000000000 + n % CHANNELS)
+        await search.add_to_list()
+
+    channels = [Channel(700000000000000000 + rng.randrange(CHANNELS))
+                for _ in range(RUNS)]
+
+    start = time.perf_counter()
+    for channel in channels:
+        await ebay.Search.get_list_display_embed(channel=channel, page=1)
+    list_ms = (time.perf_counter() - start) * 1000 / RUNS
+
+    start = time.perf_counter()
+    for channel in channels:
+        await ebay.Search.delete(["1", "2"], channel)
+    del_ms = (time.perf_counter() - start) * 1000 / RUNS
+
+    print(f"{count:>7} searches | !list {list_ms:7.3f}ms | "
+          f"!del {del_ms:7.3f}ms")
+
+
+def main():
+    counts = [int(c) for c in sys.argv[1:]] or [1000, 10000, 100000]
+    ebay.settings["max_calls"] = 10**9  # No search limit
+    directory = tempfile.mkdtemp()
+    data.settings["path"] = os.path.join(directory, "ethrift.db")
+    usage.settings["path"] = os.path.join(directory, "usage.json")
+    bot.update_presence = no_presence
+    data.delete_searches = lambda ids: None
+    rng = random.Random(0)
+    for count in counts:
+        asyncio.run(measure(count, rng))
+
+
+if __name__ == "__main__":
+    main()
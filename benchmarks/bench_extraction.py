@@ -0,0 +1,68 @@
+"""Measures how the throughput of the extraction of new items scales with
+the number of worker processes.
+
+Every response has 100 items and is extracted for a batch of 10 queries,
+as the fetch workers do. Zero processes means extracting in the main
+process, as the bot does when parse_processes is 0.
+
+Usage: python benchmarks/bench_extraction.py [responses] [max processes]
+"""
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+import extraction  # noqa: E402
+
+from bench_response_parser import build_response  # noqa: E402
+
+
+WORDS = ["selected", "ambient", "works", "cd", "85", "92", "vinyl", "tape",
+         "lp", "boxset"]
+
+
+def get_metadata(seen_items):
+    return [(r"\b" + word + r"\b", "2020-08-01T11:00:00.000Z",
+             tuple(seen_items), ()) for word in WORDS]
+
+
+def measure(processes, bodies, metadata):
+    if not processes:
+        start = time.perf_counter()
+        for body in bodies:
+            extraction.extract(body, metadata)
+        return len(bodies) / (time.perf_counter() - start)
+
+    with ProcessPoolExecutor(processes) as pool:
+        list(pool.map(extraction.extract, bodies[:processes],
+                      [metadata] * processes))  # Starts the processes
+        start = time.perf_counter()
+        list(pool.map(extraction.extract, bodies, [metadata] * len(bodies),
+                      chunksize=4))
+        return len(bodies) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    max_processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    body = build_response(100)
+    bodies = [body] * count
+    # Half of the items were seen before
+    metadata = get_metadata(110000000000 + i for i in range(0, 100, 2))
+
+    print(f"{os.cpu_count()} CPUs, {count} responses of 100 items")
+    baseline = measure(0, bodies, metadata)
+    print(f"  main process: {baseline:8.0f} responses/s")
+    processes = 1
+    while processes <= max_processes:
+        rate = measure(processes, bodies, metadata)
+        print(f"{processes:>3} processes: {rate:8.0f} responses/s "
+              f"({rate / baseline:.2f}x)")
+        processes *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Compares the Getter threads the bot used before the asyncio fetch engine
+with the engine itself, against a local stand-in of the Finding API.
+
+Both engines poll every search once against the fake Finding server of
+load_test.py and deliver the new items to a fake Discord channel per search
+that takes the given latency per message. The threads engine is the old
+Search.get_items: Getter threads making blocking ebaysdk requests and
+waiting on the event loop for every item sent. The asyncio engine is the
+real Search.start_workers, finding.execute and dispatcher path, with one
+search per batch so both engines make the same calls.
+Reports the CPU used while idle and the searches polled per second, from
+the first request until every item was delivered.
+Needs the same environment as the bot, plus ebaysdk for the threads engine.
+
+Usage: python benchmarks/bench_fetch_engine.py [--searches 1000]
+                                               [--latency 0.05]
+"""
+import argparse
+import ast
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+from load_test import run_server, to_iso  # noqa: E402
+
+
+IDLE_SECONDS = 3
+
+
+def get_url(n):
+    return f"https://www.ebay.com/sch/i.html?_nkw=kw{n}"
+
+
+def measure_idle():
+    """Returns the share of a CPU used by the process while it sleeps"""
+    cpu, wall = time.process_time(), time.perf_counter()
+    time.sleep(IDLE_SECONDS)
+    return (time.process_time() - cpu) / (time.perf_counter() - wall)
+
+
+def threads_engine(args):
+    """Runs Search.get_items as it was before the asyncio engine"""
+    import discord
+    from ebaysdk.finding import Connection as Finding
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    start_from = to_iso(time.time())
+    queue = []
+    done = []
+    sent = []
+
+    async def send(embed):
+        """Stands in for channel.send"""
+        await asyncio.sleep(args.send_latency)
+        sent.append(1)
+
+    def getter():
+        while True:
+            try:
+                keywords = queue.pop(0)
+            except IndexError:
+                time.sleep(0.01)
+                continue
+            try:
+                api = Finding(domain=f"127.0.0.1:{args.port}", https=False,
+                              appid="bench", version="1.13.0",
+                              config_file=None, site_id="EBAY-US")
+                api.config.set('https', False, force=True)
+                response = api.execute('findItemsAdvanced', {
+                    'keywords': keywords,
+                    'itemFilter': [{'name': 'StartTimeFrom',
+                                    'value': start_from}],
+                    'sortOrder': 'StartTimeNewest'})
+                data_r = ast.literal_eval(str(response.dict()))
+                items = data_r['searchResult'].get('item', [])
+                for i in items if isinstance(items, list) else [items]:
+                    embed = discord.Embed(title=i['title'],
+                                          url=i['viewItemURL'],
+                                          description="", color=0xfaa61a)
+                    embed.set_thumbnail(url=i['galleryURL'])
+                    embed.add_field(name="Price", inline=True, value=(
+                        f"${i['sellingStatus']['convertedCurrentPrice']['value']}"))
+                    embed.add_field(name="Location", inline=True,
+                                    value=f"`{i['location']}`")
+                    embed.add_field(name="Condition", inline=True, value=(
+                        f"`{i['condition']['conditionDisplayName']}`"))
+                    asyncio.run_coroutine_threadsafe(send(embed),
+                                                     loop).result()
+            except Exception as e:
+                print(f"Exception in get_items: {e}")
+            done.append(1)
+
+    for _ in range(args.workers):
+        threading.Thread(target=getter, daemon=True).start()
+
+    idle_cpu = measure_idle()
+
+    start = time.perf_counter()
+    queue.extend(f"kw{n}" for n in range(args.searches))
+    while len(done) < args.searches:
+        time.sleep(0.001)
+    return {"idle_cpu": idle_cpu,
+            "rate": args.searches / (time.perf_counter() - start),
+            "items": len(sent), "messages": len(sent)}
+
+
+def asyncio_engine(args):
+    """Runs the fetch workers of the bot"""
+    import bot
+    import data
+    import dispatcher
+    import ebay
+    import finding
+    import usage
+
+    directory = tempfile.mkdtemp()
+    data.settings["path"] = os.path.join(directory, "ethrift.db")
+    usage.settings["path"] = os.path.join(directory, "usage.json")
+    finding.settings.update(https=False, domain=f"127.0.0.1:{args.port}",
+                            appid="bench", version="1.13.0")
+    ebay.settings.update(max_calls=10**9, concurrency=args.workers,
+                         batch_size=1)
+    usage.settings["max_calls"] = 10**9
+    data.delete_searches = lambda ids: None
+
+    async def no_presence():
+        pass
+    bot.update_presence = no_presence
+
+    sent = []
+
+    async def send_message(channel_id, embeds):
+        """Stands in for the Discord HTTP request"""
+        await asyncio.sleep(args.send_latency)
+        sent.append(len(embeds))
+    dispatcher.send_message = send_message
+
+    async def run():
+        for n in range(args.searches):
+            await ebay.Search(get_url(n), 700000000000000000 + n).add_to_list()
+        ebay.Search.start_workers()
+
+        cpu, wall = time.process_time(), time.perf_counter()
+        await asyncio.sleep(IDLE_SECONDS)
+        idle_cpu = (time.process_time() - cpu) / (time.perf_counter() - wall)
+
+        start = time.perf_counter()
+        for batch in ebay.batch_list:
+            ebay.Search.enqueue(batch)
+        await ebay.queue.join()
+        while any(c.task for c in dispatcher.channels.values()):
+            await asyncio.sleep(0.001)
+        rate = args.searches / (time.perf_counter() - start)
+
+        for worker in ebay.workers:
+            worker.cancel()
+        await finding.close()
+        return {"idle_cpu": idle_cpu, "rate": rate,
+                "items": sum(sent), "messages": len(sent)}
+
+    return asyncio.new_event_loop().run_until_complete(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--searches", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=20,
+                        help="Getter threads and fetch workers")
+    parser.add_argument("--rate", type=float, default=20,
+                        help="new listings per minute of every search")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds the fake Finding API takes to answer")
+    parser.add_argument("--send-latency", type=float, default=0.01,
+                        help="seconds the fake Discord channel takes per message")
+    parser.add_argument("--port", type=int, default=8090)
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=run_server, args=(args.port, args.rate, args.latency, ready),
+        daemon=True)
+    server.start()
+    ready.wait()
+
+    print(f"{args.searches} searches, {args.latency*1000:.0f}ms per request, "
+          f"{args.workers} workers")
+    try:
+        for name, engine in (("threads", threads_engine),
+                             ("asyncio", asyncio_engine)):
+            # Each engine runs in its own process so leftover threads
+            # do not count towards the other one's CPU time
+            with multiprocessing.Pool(1) as pool:
+                result = pool.apply(engine, (args,))
+            print(f"{name:>8}: idle CPU {result['idle_cpu']*100:5.1f}%  |  "
+                  f"{result['rate']:8.1f} searches/s  |  "
+                  f"{result['items']} items in {result['messages']} messages")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Measures the cost per item of the checks run on the response items.
+
+Compares parsing the search URL for every item, as the checks used to do,
+with the predicates compiled once when the search is added.
+Needs the requirements of the bot.
+
+Usage: python benchmarks/bench_predicates.py [items]
+"""
+import os
+import random
+import sys
+import time
+import urllib.parse as urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+import ebay  # noqa: E402
+
+
+URLS = {"no filters": "https://www.ebay.com/sch/i.html?_nkw=tr-808",
+        "best offer": "https://www.ebay.com/sch/i.html?_nkw=tr-808&LH_BO=1",
+        "all filters": "https://www.ebay.com/sch/i.html?_nkw=tr-808&LH_BO=1"
+                       "&LH_FS=1&_ssn=synthshop&_udlo=100&_udhi=1500"}
+
+
+def filter_url(url, item):
+    """Checks the item the way it was done before the predicates, parsing
+    the search URL for every item. Only the best offer filter was checked."""
+    parsed = urlparse.urlparse(url)
+    query = urlparse.parse_qs(parsed.query)
+    if query.get('LH_BO') and item.get('bestOfferEnabled') == "false":
+        return False
+    return True
+
+
+def random_item(rng):
+    return {'itemId': f"{rng.randrange(10**11, 10**12)}",
+            'price': f"{rng.uniform(1, 2000):.2f}",
+            'bestOfferEnabled': rng.choice(["true", "false"]),
+            'shippingType': rng.choice(["Free", "Flat", "Calculated"]),
+            'shippingCost': rng.choice(["0.0", "9.99"]),
+            'seller': rng.choice(["synthshop", "SynthShop", "recordstore"])}
+
+
+def measure(function, items):
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    return (time.perf_counter() - start) * 10**9 / len(items)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    rng = random.Random(0)
+    items = [random_item(rng) for _ in range(count)]
+
+    for name, url in URLS.items():
+        predicates = ebay.Search(url, 1).predicates
+        before = measure(lambda i: filter_url(url, i), items)
+        after = measure(predicates, items)
+        passed = sum(map(predicates, items))
+        print(f"{name:>12}: url parsing {before:7.0f}ns/item | "
+              f"predicates {after:7.0f}ns/item | {passed} of {count} passed")
+
+
+if __name__ == "__main__":
+    main()
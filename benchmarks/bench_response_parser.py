@@ -0,0 +1,106 @@
+"""Compares the previous response parsing path with finding.parse_items.
+
+The previous path parsed the whole XML body into a dictionary the same way
+ebaysdk does, and then copied it through ast.literal_eval(str(...)).
+
+Usage: python benchmarks/bench_response_parser.py [items] [repeat]
+"""
+import ast
+import os
+import sys
+import timeit
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+import finding  # noqa: E402
+
+
+ITEM = """<item><itemId>{id}</itemId><title>Selected Ambient Works 85-92 CD {id}</title>
+<globalId>EBAY-US</globalId><primaryCategory><categoryId>176984</categoryId>
+<categoryName>Music CDs</categoryName></primaryCategory>
+<galleryURL>https://thumbs1.ebaystatic.com/m/{id}/140.jpg</galleryURL>
+<viewItemURL>https://www.ebay.com/itm/{id}</viewItemURL><autoPay>true</autoPay>
+<postalCode>10001</postalCode><location>New York,NY,USA</location><country>US</country>
+<shippingInfo><shippingServiceCost currencyId="USD">3.99</shippingServiceCost>
+<shippingType>Flat</shippingType><shipToLocations>Worldwide</shipToLocations>
+<expeditedShipping>false</expeditedShipping><oneDayShippingAvailable>false</oneDayShippingAvailable>
+<handlingTime>1</handlingTime></shippingInfo>
+<sellingStatus><currentPrice currencyId="USD">9.99</currentPrice>
+<convertedCurrentPrice currencyId="USD">9.99</convertedCurrentPrice>
+<sellingState>Active</sellingState><timeLeft>P29DT23H59M0S</timeLeft></sellingStatus>
+<listingInfo><bestOfferEnabled>false</bestOfferEnabled><buyItNowAvailable>false</buyItNowAvailable>
+<startTime>2020-08-01T12:00:{second:02d}.000Z</startTime><endTime>2020-08-31T12:00:00.000Z</endTime>
+<listingType>FixedPrice</listingType><gift>false</gift></listingInfo>
+<returnsAccepted>true</returnsAccepted><condition><conditionId>3000</conditionId>
+<conditionDisplayName>Used</conditionDisplayName></condition>
+<isMultiVariationListing>false</isMultiVariationListing><topRatedListing>false</topRatedListing></item>"""
+
+
+def build_response(items):
+    """Returns a findItemsAdvanced response body with the given number of items"""
+    body = ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<findItemsAdvancedResponse xmlns="http://www.ebay.com/marketplace/search/v1/services">'
+            '<ack>Success</ack><version>1.13.0</version><timestamp>2020-08-01T12:01:00.000Z</timestamp>'
+            f'<searchResult count="{items}">')
+    body += "".join(ITEM.format(id=110000000000 + i, second=59 - i % 60)
+                    for i in range(items))
+    body += ('</searchResult><paginationOutput><pageNumber>1</pageNumber>'
+             f'<entriesPerPage>{items}</entriesPerPage><totalPages>1</totalPages>'
+             f'<totalEntries>{items}</totalEntries></paginationOutput>'
+             '</findItemsAdvancedResponse>')
+    return body.encode('utf-8')
+
+
+def element_to_dict(element):
+    """ebaysdk style conversion of an element to a dictionary"""
+    children = list(element)
+    if not children and not element.attrib:
+        return element.text
+    result = {f"_{k}": v for k, v in element.attrib.items()}
+    for child in children:
+        tag = child.tag.replace(finding.NAMESPACE, '')
+        if tag == 'item':
+            result.setdefault(tag, []).append(element_to_dict(child))
+        else:
+            result[tag] = element_to_dict(child)
+    if element.text and element.text.strip():
+        result['value'] = element.text
+    return result
+
+
+def previous_path(body):
+    data_r = ast.literal_eval(str(element_to_dict(ElementTree.fromstring(body))))
+    return data_r['searchResult']['item']
+
+
+def parse_items(body):
+    return list(finding.parse_items(body))
+
+
+def parse_first_items(body, count=5):
+    """Stops after the first items, like a poll with a few new items"""
+    result = []
+    for item in finding.parse_items(body):
+        result.append(item)
+        if len(result) == count:
+            break
+    return result
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    body = build_response(items)
+
+    print(f"{items} items, {len(body)/1024:.1f} KiB per response")
+    for name, function in (("ast.literal_eval path", previous_path),
+                           ("parse_items (all)", parse_items),
+                           ("parse_items (5 new)", parse_first_items)):
+        seconds = min(timeit.repeat(lambda: function(body), number=repeat,
+                                    repeat=3)) / repeat
+        print(f"{name:>22}: {seconds*1000:7.3f} ms per response")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Measures the resident memory of the list of searches and of items.
+
+Adds searches from realistic URLs spread over many channels, with part of
+them duplicated across channels, and reports the memory used per search.
+Needs the requirements of the bot.
+
+Usage: python benchmarks/bench_search_memory.py [searches]
+"""
+import asyncio
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+import ebay  # noqa: E402
+
+
+WORDS = ["selected", "ambient", "works", "cd", "vinyl", "roland", "tr-808",
+         "drum", "machine", "synth", "korg", "moog", "lp", "first", "press",
+         "japan", "obi", "sealed", "rare", "cassette", "minidisc", "sony"]
+SITES = ["www.ebay.com", "www.ebay.co.uk", "www.ebay.de", "www.ebay.fr"]
+FILTERS = ["", "&LH_BIN=1", "&_udlo=10&_udhi=200", "&LH_ItemCondition=3|4",
+           "&LH_PrefLoc=3", "&LH_BO=1&LH_BIN=1"]
+
+
+def random_url(rng):
+    keywords = "+".join(rng.sample(WORDS, rng.randint(1, 4)))
+    return (f"https://{rng.choice(SITES)}/sch/i.html?_nkw={keywords}"
+            f"{rng.choice(FILTERS)}")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(0)
+    urls = [random_url(rng) for _ in range(count)]
+    ebay.settings["max_calls"] = 10**9  # No search limit
+
+    async def add_searches():
+        for n, url in enumerate(urls):
+            await ebay.Search(url, 700000000000000000 + n % 5000).add_to_list()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    asyncio.run(add_searches())
+    used = tracemalloc.get_traced_memory()[0] - before
+
+    print(f"{len(ebay.search_list)} searches, {len(ebay.query_list)} queries, "
+          f"{len(ebay.batch_list)} batches")
+    print(f"  searches: {used / 1024 / 1024:8.2f} MiB "
+          f"({used / count:.0f} bytes per search)")
+
+    before = tracemalloc.get_traced_memory()[0]
+    items = [ebay.Item(id=str(110000000000 + n), title=f"Roland TR-808 {n}",
+                       price="1499.99", url=f"https://www.ebay.com/itm/{n}",
+                       location="Tokyo,Japan", condition="Used",
+                       thumbnail=f"https://thumbs1.ebaystatic.com/m/{n}/140.jpg",
+                       start_time="2020-08-01T12:00:00.000Z")
+             for n in range(10000)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    print(f"     items: {used / len(items):8.0f} bytes per item")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Measures the memory used by the seen items of every query.
+
+Runs 200 realistic 12 digit item IDs through the seen items of each query,
+the given number of them being listed in every second, and reports the
+memory used per query and in total.
+
+Usage: python benchmarks/bench_seen_items.py [queries] [items_per_second]
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+import seen  # noqa: E402
+
+
+def main():
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    per_second = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    indexes = []
+    item_id = 110000000000
+    for _ in range(queries):
+        index = seen.SeenItems()
+        for n in range(200):
+            # The newest second moves on every per_second items
+            if n % per_second:
+                index.add([str(item_id)])
+            else:
+                index.move([str(item_id)])
+            item_id += 1
+        indexes.append(index)
+
+    used = tracemalloc.get_traced_memory()[0] - before
+    print(f"{queries} queries, {per_second} items listed per second")
+    print(f"  per query: {used / queries / 1024:8.2f} KiB")
+    print(f"      total: {used / 1024 / 1024:8.2f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Measures the cold start of the bot: the time to import its modules and
+the time from reading the stored searches to the scheduler being ready to
+poll them.
+
+Every number of searches runs in a fresh process against a temporary
+SQLite storage. Searches are spread over 10 searches per channel and one
+in ten has title rules. Half of the searches are single words, which are
+batched together. Channels are resolved by a stand-in of the Discord
+client, so no connection to Discord is needed.
+
+Usage: python benchmarks/bench_startup.py [searches ...]
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+
+SEARCHES_PER_CHANNEL = 10
+SITES = ["www.ebay.com", "www.ebay.co.uk", "www.ebay.de"]
+WORDS = ["selected", "ambient", "works", "cd", "85", "92", "vinyl", "tape",
+         "lp", "boxset", "aphex", "twin", "warp", "rare", "promo", "sealed"]
+
+
+def get_records(count):
+    rng = random.Random(count)
+    records = []
+    for n in range(count):
+        if n % 2:
+            keywords = f"kw{n}"
+        else:
+            keywords = "+".join(rng.sample(WORDS, 3)) + f"+kw{n}"
+        url = f"https://{rng.choice(SITES)}/sch/i.html?_nkw={keywords}"
+        if n % 4 == 0:
+            url += "&LH_BIN=1&_udhi=50"
+        records.append({"url": url,
+                        "channel_id": 700000000000000000 + n // SEARCHES_PER_CHANNEL,
+                        "include": ["mint"] if n % 10 == 0 else [],
+                        "exclude": [f"broken{n % 50}"] if n % 10 == 0 else []})
+    return records
+
+
+def run(count, path, results):
+    start = time.perf_counter()
+    import bot
+    import data
+    import ebay
+    import scheduler
+    import usage
+    imported = time.perf_counter() - start
+
+    data.settings["path"] = path
+    usage.settings["path"] = os.path.join(os.path.dirname(path), "usage.json")
+    ebay.settings["max_calls"] = usage.settings["max_calls"] = 10**7
+    channels = {r["channel_id"] for r in get_records(count)}
+
+    class Client:
+        def get_channel(self, channel_id):
+            return channel_id if channel_id in channels else None
+
+    bot.bot = Client()
+
+    async def no_presence():
+        pass
+    bot.update_presence = no_presence
+
+    async def main():
+        start = time.perf_counter()
+        await ebay.Search.read_searches()
+        ready = time.perf_counter() - start
+        scheduler.task.cancel()
+        for worker in ebay.workers:
+            worker.cancel()
+        return ready
+
+    ready = asyncio.new_event_loop().run_until_complete(main())
+    results.update(imported=imported, ready=ready,
+                   searches=len(ebay.search_list),
+                   queries=len(ebay.query_list), batches=len(ebay.batch_list))
+
+
+def measure(count):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "ethrift.db")
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+    import data
+    data.SQLiteStorage(path).add_many(get_records(count))
+
+    with multiprocessing.Manager() as manager:
+        results = manager.dict()
+        process = multiprocessing.Process(target=run,
+                                          args=(count, path, results))
+        process.start()
+        process.join()
+        return dict(results)
+
+
+def main():
+    counts = [int(n) for n in sys.argv[1:]] or [1000, 10000, 50000]
+    print(f"{'searches':>9} {'queries':>8} {'batches':>8} "
+          f"{'import s':>9} {'ready s':>8}")
+    for count in counts:
+        result = measure(count)
+        print(f"{result['searches']:>9} {result['queries']:>8} "
+              f"{result['batches']:>8} {result['imported']:>9.2f} "
+              f"{result['ready']:>8.2f}")
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    main()
@@ -0,0 +1,72 @@
+"""Compares the latency of adding and deleting a search with 10k searches
+stored, between the previous JSONBin full document save and SQLite.
+
+The previous path built the whole document, sleeping 10ms per search, and
+serialized it before every PUT. The network time of the PUT itself is not
+included. Needs the requirements of the bot.
+
+Usage: python benchmarks/bench_storage.py [searches] [operations]
+"""
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+import data  # noqa: E402
+
+
+SLEEP_PER_SEARCH = 0.01  # asyncio.sleep in the previous Search.save_searches
+
+
+def previous_save(records):
+    """Builds and serializes the document like the previous save_searches,
+    without the sleeps, which are added afterwards"""
+    data_s = {'searches': []}
+    for r in records:
+        data_s['searches'].append({'url': r['url'],
+                                   'channel_id': f"{r['channel_id']}"})
+    return json.dumps(data_s)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    records = [{'url': f"https://www.ebay.com/sch/i.html?_nkw=search+{n}",
+                'channel_id': 700000000000000000 + n % 5000}
+               for n in range(count)]
+
+    timings = []
+    for _ in range(20):
+        start = time.perf_counter()
+        previous_save(records)
+        timings.append(time.perf_counter() - start)
+    previous = statistics.median(timings) + count * SLEEP_PER_SEARCH
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage = data.SQLiteStorage(os.path.join(directory, "bench.db"))
+        storage.add_many(records)
+
+        adds, deletes = [], []
+        for n in range(operations):
+            start = time.perf_counter()
+            id = storage.add(f"https://www.ebay.com/sch/i.html?_nkw=new+{n}",
+                             700000000000000000)
+            adds.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            storage.delete([id])
+            deletes.append(time.perf_counter() - start)
+        storage.connection.close()
+
+    print(f"{count} searches stored")
+    print(f"  previous save (add or delete): {previous:10.3f} s")
+    print(f"  sqlite add (p50):              {statistics.median(adds)*1000:10.3f} ms")
+    print(f"  sqlite delete (p50):           {statistics.median(deletes)*1000:10.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""Load test of the whole polling and notification pipeline.
+
+Runs the real Search, Query, Batch and Item code, the scheduler, the fetch
+workers and the dispatcher against a local stand-in of the Finding API and
+a fake Discord channel sink, so no eBay calls or Discord messages are used.
+
+The fake Finding server runs in its own process. Every search gets a unique
+keyword and new listings appear for every keyword at the given rate. The
+server answers findItemsAdvanced requests with the listings started since
+StartTimeFrom, newest first, after the given latency.
+
+Every number of searches runs in a fresh process and the results are written
+to a JSON file that can be compared between releases: Finding calls and
+items sent per second, response bytes per poll, CPU and peak memory of the
+pipeline process and the lag between an item being listed and being sent.
+Needs the requirements of the bot.
+
+Usage: python benchmarks/load_test.py [--searches 100 1000 10000 100000]
+                                      [--duration 60] [--output load_test.json]
+                                      [--page-size adaptive|full]
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+
+SEARCHES_PER_CHANNEL = 10
+
+ITEM = ("<item><itemId>{id}</itemId><title>{term} listing {n}</title>"
+        "<galleryURL>https://thumbs1.ebaystatic.com/m/{id}/140.jpg</galleryURL>"
+        "<viewItemURL>https://www.ebay.com/itm/{id}</viewItemURL>"
+        "<location>New York,NY,USA</location><country>US</country>"
+        "<sellingStatus><convertedCurrentPrice currencyId=\"USD\">9.99"
+        "</convertedCurrentPrice></sellingStatus>"
+        "<listingInfo><bestOfferEnabled>false</bestOfferEnabled>"
+        "<startTime>{start_time}</startTime></listingInfo>"
+        "<condition><conditionDisplayName>Used</conditionDisplayName>"
+        "</condition></item>")
+
+
+def to_iso(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def from_iso(iso):
+    return datetime.strptime(iso[:19], "%Y-%m-%dT%H:%M:%S").replace(
+        tzinfo=timezone.utc).timestamp()
+
+
+def run_server(port, rate, latency, ready):
+    """Runs the fake Finding API until the process is terminated
+
+    Keyword Arguments:
+        port               -- port to listen on
+        rate               -- new listings per minute of every keyword
+        latency            -- seconds before every response is sent
+    """
+    from aiohttp import web
+
+    started_at = time.time()
+    interval = 60 / rate
+
+    def get_items(term, start_from, now):
+        """Returns the start time and XML of the term's listings started
+        between start_from and now"""
+        number = int(term[2:])
+        first = max(math.ceil((start_from - started_at) / interval), 0)
+        last = int((now - started_at) / interval)
+        return [(started_at + n * interval,
+                 ITEM.format(id=10**11 + number * 10**5 + n, term=term, n=n,
+                             start_time=to_iso(started_at + n * interval)))
+                for n in range(first, last + 1)]
+
+    async def handle(request):
+        body = (await request.read()).decode()
+        keywords = re.search(r"<keywords>(.*?)</keywords>", body).group(1)
+        start_from = re.search(r"<name>StartTimeFrom</name><value>(.*?)</value>",
+                               body)
+        page = re.search(r"<pageNumber>(\d+)</pageNumber>", body)
+        entries = re.search(r"<entriesPerPage>(\d+)</entriesPerPage>", body)
+        page = int(page.group(1)) if page else 1
+        entries = int(entries.group(1)) if entries else 100
+
+        now = time.time()
+        start_from = from_iso(start_from.group(1)) if start_from else 0
+        items = []
+        for term in keywords.strip("()").split(","):
+            items += get_items(term, start_from, now)
+        items.sort(reverse=True)
+        items = items[(page - 1) * entries:page * entries]
+
+        await asyncio.sleep(latency)
+        return web.Response(
+            content_type="text/xml",
+            text=('<?xml version="1.0" encoding="UTF-8"?>'
+                  '<findItemsAdvancedResponse xmlns="http://www.ebay.com/'
+                  'marketplace/search/v1/services"><ack>Success</ack>'
+                  f'<searchResult count="{len(items)}">'
+                  + "".join(xml for _, xml in items)
+                  + '</searchResult></findItemsAdvancedResponse>'))
+
+    app = web.Application()
+    app.router.add_post("/services/search/FindingService/v1", handle)
+    runner = web.AppRunner(app)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+    ready.set()
+    loop.run_forever()
+
+
+def run_pipeline(searches, args):
+    """Runs the pipeline with the given number of searches against the
+    fake Finding API and returns its results"""
+    import bot
+    import data
+    import dispatcher
+    import ebay
+    import finding
+    import metrics
+    import scheduler
+    import usage
+
+    finding.settings.update(https=False, domain=f"127.0.0.1:{args.port}",
+                            appid="load-test", version="1.13.0")
+    directory = tempfile.mkdtemp()
+    data.settings["path"] = os.path.join(directory, "ethrift.db")
+    usage.settings["path"] = os.path.join(directory, "usage.json")
+    # The daily budget is set so the scheduler plans the given calls per second
+    usage.settings["max_calls"] = int(args.calls_per_second
+                                      * usage.get_seconds_to_reset())
+    ebay.settings["max_calls"] = usage.settings["max_calls"]
+    scheduler.MIN_INTERVAL = args.min_interval
+    if args.page_size == "full":
+        ebay.MIN_ENTRIES_PER_PAGE = finding.ENTRIES_PER_PAGE
+        ebay.MAX_FOLLOW_PAGES = 1
+    data.delete_searches = lambda ids: None
+
+    async def no_presence():
+        pass
+    bot.update_presence = no_presence
+
+    sent = []
+    lags = []
+    polls = []
+
+    enqueue = ebay.Search.enqueue
+
+    def count_poll(batch):
+        polls.append(batch)
+        enqueue(batch)
+    ebay.Search.enqueue = count_poll
+
+    async def send_message(channel_id, embeds):
+        await asyncio.sleep(args.send_latency)
+        sent.append(len(embeds))
+    dispatcher.send_message = send_message
+
+    # Item lag is taken from the metrics hook, without starting the server
+    metrics.enabled = True
+    metrics.observe_sent = lambda start_time: lags.append(
+        (datetime.utcnow() - start_time).total_seconds())
+
+    async def run():
+        for n in range(searches):
+            url = f"https://www.ebay.com/sch/i.html?_nkw=kw{n}"
+            channel_id = 700000000000000000 + n // SEARCHES_PER_CHANNEL
+            await ebay.Search(url, channel_id).add_to_list()
+        ebay.Search.start_workers()
+        bot.start_get_items()
+
+        await asyncio.sleep(args.warmup)
+        calls = usage.counters["calls"]
+        received = get_bytes()
+        sent.clear()
+        lags.clear()
+        polls.clear()
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = rusage.ru_utime + rusage.ru_stime
+        start = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - start
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = rusage.ru_utime + rusage.ru_stime - cpu
+        calls = usage.counters["calls"] - calls
+        received = get_bytes() - received
+        await finding.close()
+
+        lags.sort()
+        return {"searches": searches,
+                "queries": len(ebay.query_list),
+                "batches": len(ebay.batch_list),
+                "seconds": round(elapsed, 1),
+                "calls": calls,
+                "calls_per_second": round(calls / elapsed, 2),
+                "errors": usage.counters["errors"],
+                "polls": len(polls),
+                "bytes_per_poll": round(received / len(polls)) if polls else None,
+                "items_sent": sum(sent),
+                "items_per_second": round(sum(sent) / elapsed, 2),
+                "messages": len(sent),
+                "cpu_seconds": round(cpu, 2),
+                "cpu_percent": round(cpu / elapsed * 100, 1),
+                "max_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+                "lag_p50": round(statistics.median(lags), 2) if lags else None,
+                "lag_p95": round(lags[int(len(lags) * 0.95)], 2) if lags else None,
+                "lag_max": round(lags[-1], 2) if lags else None}
+
+    def get_bytes():
+        return sum(s["bytes"] for s in finding.stats.values())
+
+    return asyncio.get_event_loop().run_until_complete(run())
+
+
+def get_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--searches", type=int, nargs="+",
+                        default=[100, 1000, 10000, 100000])
+    parser.add_argument("--duration", type=float, default=60,
+                        help="seconds measured after the warmup")
+    parser.add_argument("--warmup", type=float, default=None,
+                        help="seconds before measuring (default: min interval)")
+    parser.add_argument("--calls-per-second", type=float, default=20,
+                        help="Finding calls per second planned by the scheduler")
+    parser.add_argument("--min-interval", type=float, default=10,
+                        help="shortest interval a batch is polled at")
+    parser.add_argument("--rate", type=float, default=1,
+                        help="new listings per minute of every search")
+    parser.add_argument("--latency", type=float, default=0.15,
+                        help="seconds the fake Finding API takes to answer")
+    parser.add_argument("--send-latency", type=float, default=0.05,
+                        help="seconds the fake Discord channel takes per message")
+    parser.add_argument("--page-size", choices=("adaptive", "full"),
+                        default="adaptive",
+                        help="full requests 100 items every poll and never "
+                             "follows the next pages, as before pages were "
+                             "sized from the rate of new items")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--output", default="load_test.json")
+    args = parser.parse_args()
+    if args.warmup is None:
+        args.warmup = args.min_interval
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=run_server, args=(args.port, args.rate, args.latency, ready),
+        daemon=True)
+    server.start()
+    ready.wait()
+
+    results = []
+    try:
+        for searches in args.searches:
+            with multiprocessing.Pool(1) as pool:
+                result = pool.apply(run_pipeline, (searches, args))
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        server.terminate()
+
+    with open(args.output, "w") as file:
+        json.dump({"version": get_version(),
+                   "python": platform.python_version(),
+                   "cpus": os.cpu_count(),
+                   "settings": {k: v for k, v in vars(args).items()
+                                if k not in ("searches", "output", "port")},
+                   "results": results}, file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
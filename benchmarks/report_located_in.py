@@ -0,0 +1,115 @@
+"""Reports the Finding calls per day saved by the LocatedIn request plans
+on the stored searches.
+
+The searches are loaded twice: with the plans the bot has now, and as
+they were requested before, with a request per 25 countries of the whole
+item location list, duplicates included. Calls per day are the calls of
+every batch polled at the even interval the bot would use with the old
+costs.
+Reads the storage and max_daily_calls from settings.yaml, or from the
+given settings file.
+
+Usage: python benchmarks/report_located_in.py [--max-calls 5000]
+                                              [--settings settings.yaml]
+"""
+import argparse
+import os
+import sys
+import urllib.parse as urlparse
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../ethrift"))
+
+import utils  # noqa: E402
+import data  # noqa: E402
+import ebay  # noqa: E402
+import mapping  # noqa: E402
+import usage  # noqa: E402
+
+
+def get_prefloc(query):
+    """Returns the item location value of the query's URL, if any"""
+    query_string = urlparse.parse_qs(urlparse.urlparse(query.url).query)
+    prefloc = query_string.get('LH_PrefLoc')
+    try:
+        return int(prefloc[0]) if prefloc else None
+    except ValueError:
+        return None
+
+
+def get_old_plans():
+    """Returns the LocatedIn filters of every ebay website and item location
+    value as they were sent before the request plans: the whole country
+    lists, duplicates included"""
+    return {(global_id, prefloc): countries
+            for global_id, values in mapping.EBAY_GLOBAL_ID_LOCATED_IN.items()
+            for prefloc, countries in values.items()}
+
+
+def get_costs(records, plans):
+    """Loads the searches with the given LocatedIn plans and returns the
+    calls of a poll of every ebay website and item location value"""
+    ebay.search_list.clear()
+    ebay.channel_searches.clear()
+    ebay.query_list.clear()
+    ebay.batch_list.clear()
+    ebay.batch_groups.clear()
+    ebay.total_search_cost = 0
+    mapping.LOCATED_IN_PLANS = plans
+    ebay.Search.add_many(records)
+
+    costs = {}
+    for batch in ebay.batch_list:
+        # Batches can mix location values with the same countries, so
+        # their calls are split between them
+        for query in batch.queries:
+            location = (query.ebay_site, get_prefloc(query))
+            costs[location] = costs.get(location, 0) \
+                + batch.get_cost() / len(batch.queries)
+    return costs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--max-calls", type=int, default=None,
+                        help="daily calls (default: max_daily_calls)")
+    parser.add_argument("--settings", default=utils.get_file_path("../settings.yaml"),
+                        help="settings file with the storage to report on")
+    args = parser.parse_args()
+
+    with open(args.settings) as file:
+        _settings = yaml.safe_load(file)
+    data.read_settings(_settings)
+    max_calls = args.max_calls or _settings["ebay"]["max_daily_calls"]
+    usage.settings["max_calls"] = max_calls
+
+    records = data.load_searches()
+    if not records:
+        print("No searches stored")
+        return
+    new_plans = mapping.LOCATED_IN_PLANS
+    old = get_costs(records, get_old_plans())
+    new = get_costs(records, new_plans)
+    old_total, new_total = sum(old.values()), sum(new.values())
+
+    old_interval = 86400 * old_total / max_calls
+    polls = 86400 / old_interval
+    print(f"{len(ebay.search_list)} searches, {len(ebay.query_list)} queries, "
+          f"{len(ebay.batch_list)} batches, {max_calls} calls per day\n")
+    print(f"{'site':<10} {'LH_PrefLoc':>10} {'old calls':>10} "
+          f"{'new calls':>10} {'saved per day':>14}")
+    for site, prefloc in sorted(old, key=lambda l: new.get(l, 0) - old[l]):
+        o, n = old[site, prefloc], new.get((site, prefloc), 0)
+        print(f"{site or '-':<10} {prefloc or '-':>10} {o:>10.1f} {n:>10.1f} "
+              f"{(o - n) * polls:>14.0f}")
+    print(f"\nCalls per cycle: {old_total:.0f} -> {new_total:.0f}")
+    print(f"Even interval: {old_interval:.0f}s -> "
+          f"{86400 * new_total / max_calls:.0f}s")
+    print(f"Calls saved per day at the old interval: "
+          f"{(old_total - new_total) * polls:.0f} "
+          f"({(old_total - new_total) / old_total:.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,19 @@ import yaml
 import math
 import discord
 import asyncio
-from discord.ext import commands, tasks
+from discord.ext import commands
 from datetime import datetime
 
 # Internal modules
 import utils
+import data
 import ebay
+import finding
+import dispatcher
+import scheduler
+import usage as api_usage
+import tracing
+import circuit
 
 
 loop = asyncio.new_event_loop()
@@ -16,6 +23,7 @@ asyncio.set_event_loop(loop)
 
 token = ""
 max_interval = 0
+items_interval = 30
 bot = commands.Bot(command_prefix='!')
 bot.remove_command('help')
 
@@ -37,7 +45,11 @@ async def cmd(ctx):
                                            "\n"  # TODO: Create a wiki and add information about supported filters
                                            "\n`!add <url>` › Add search from URL (read the [wiki](https://github.com/tiagosvf/ethrift/wiki) for [supported filters](https://github.com/tiagosvf/ethrift/wiki/Support#filters))"
                                            "\n`!del <search numbers (#) separated by spaces>` › Remove searches"
-                                           "\n`!searches`, `!list` or `!lst` `[page]` › List all currently active searches", inline=True)
+                                           "\n`!searches`, `!list` or `!lst` `[page]` › List all currently active searches"
+                                           "\n`!include <search number (#)> <terms>` › Only show items whose titles contain every term"
+                                           "\n`!exclude <search number (#)> <terms>` › Hide items whose titles contain any term"
+                                           "\n`!rules <search number (#)> [clear]` › Show or remove the title rules of a search"
+                                           "\n`!usage` › Show the eBay API calls used today", inline=True)
     await ctx.send(embed=embed)
 
 
@@ -89,6 +101,145 @@ async def delete(ctx, *indexes):
         print(e)
 
 
+async def send_rules_result(ctx, result, message):
+    """Sends the result of changing the title rules of a search"""
+    if result:
+        await ctx.send(embed=result)
+    else:
+        await ctx.send(f"```{message}```")
+
+
+@bot.command()
+async def include(ctx, index, *terms):
+    """Adds terms that the titles of the search's items must all contain
+
+    Usage: !include <index> <terms>
+    Example: !include 2 cd "first press"
+    Result: search 2 only shows items with both "cd" and "first press"
+    in the title
+    """
+    result, message = await ebay.Search.edit_rules(index, ctx.channel,
+                                                   include=terms)
+    await send_rules_result(ctx, result, message)
+
+
+@bot.command()
+async def exclude(ctx, index, *terms):
+    """Adds terms that the titles of the search's items must not contain
+
+    Usage: !exclude <index> <terms>
+    Example: !exclude 2 broken "for parts"
+    Result: search 2 hides items with "broken" or "for parts" in the title
+    """
+    result, message = await ebay.Search.edit_rules(index, ctx.channel,
+                                                   exclude=terms)
+    await send_rules_result(ctx, result, message)
+
+
+@bot.command()
+async def rules(ctx, index, action=None):
+    """Shows the title rules of the search, or removes them
+
+    Usage: !rules <index> [clear]
+    Example: !rules 2 clear
+    Result: search 2 shows every item again
+    """
+    result, message = await ebay.Search.edit_rules(index, ctx.channel,
+                                                   clear=action == "clear")
+    await send_rules_result(ctx, result, message)
+
+
+@bot.command()
+@commands.is_owner()
+async def pool(ctx):
+    """Shows the Finding API connection pool counters of every ebay site"""
+    pool_stats = finding.get_pool_stats()
+    paused = circuit.get_open_sites()
+    if not pool_stats:
+        await ctx.send("```No requests have been made yet.```")
+        return
+    lines = [f"{site_id}: {s['calls']} calls | {s['hits']} hits | "
+             f"{s['misses']} misses | {s['handshakes']} handshakes | "
+             f"p50 {s['p50']:.0f}ms | "
+             f"{s['bytes'] / max(s['calls'], 1) / 1024:.1f} KiB per call"
+             f"{' | paused' if site_id in paused else ''}"
+             for site_id, s in pool_stats.items()]
+    await ctx.send("```" + "\n".join(lines) + "```")
+
+
+@bot.command()
+async def usage(ctx):
+    """Shows the eBay API calls used today, the calls projected by the
+    end of the day and the headroom left"""
+    _usage = api_usage.get_usage(scheduler.get_calls_per_second())
+    await ctx.send(f"```Calls used today: {_usage['used']} / {ebay.get_max_calls()}"
+                   f"\nProjected by the end of the day: {_usage['projected']}"
+                   f"\nHeadroom: {_usage['headroom']}"
+                   f"\nFailed calls: {_usage['errors']} "
+                   f"({_usage['limit_errors']} over the call limit)```")
+
+
+@bot.command()
+@commands.is_owner()
+async def queues(ctx):
+    """Shows the channels with the most items waiting to be sent"""
+    stats = sorted(dispatcher.get_stats().items(),
+                   key=lambda s: s[1]["queued"], reverse=True)[:15]
+    if not stats:
+        await ctx.send("```No items have been sent yet.```")
+        return
+    lines = [f"{channel_id}: {s['queued']} queued | {s['sent']} sent | "
+             f"p50 {s['p50']:.0f}ms"
+             for channel_id, s in stats]
+    await ctx.send("```" + "\n".join(lines) + "```")
+
+
+@bot.command()
+@commands.is_owner()
+async def storage(ctx, action=None):
+    """Shows how long the oldest unsaved change has been waiting to be
+    written and when the last write succeeded, or exports the searches
+
+    Usage: !storage [export]
+    """
+    if action == "export":
+        if not data.is_exported():
+            await ctx.send("```Exporting is not enabled in the settings.```")
+        elif data.export():
+            await ctx.send("```Searches queued to be exported to JSONBin.```")
+        else:
+            await ctx.send("```No changes since the last export.```")
+        return
+    stats = data.get_writer_stats()
+    written_at = stats["written_at"]
+    written_at = written_at.strftime("%Y-%m-%d %H:%M:%S") if written_at else "never"
+    await ctx.send(f"```Write lag: {stats['lag']:.1f}s"
+                   f"\nLast successful write: {written_at}```")
+
+
+@bot.command()
+@commands.is_owner()
+async def trace(ctx, action=None):
+    """Starts or stops recording spans of the polling cycles, or sends the
+    recorded spans as a Chrome trace file
+
+    Usage: !trace [on|off]
+    """
+    if action == "on":
+        tracing.start(tracing.settings["size"])
+        await ctx.send("```Tracing started.```")
+    elif action == "off":
+        tracing.stop()
+        await ctx.send("```Tracing stopped.```")
+    elif not tracing.spans:
+        await ctx.send("```No spans have been recorded. Use !trace on to start.```")
+    else:
+        path = utils.get_file_path("../trace.json")
+        count = tracing.dump(path)
+        await ctx.send(f"```{count} spans. Open the file in chrome://tracing "
+                       "or ui.perfetto.dev```", file=discord.File(path))
+
+
 @bot.event
 async def on_command_error(ctx, error):
     """Handles uncaught exceptions when using commands"""
@@ -99,16 +250,16 @@ async def on_command_error(ctx, error):
         await ctx.send("```An error occurred.\nUse !help to make sure you used the command correctly.```")
 
 
-@tasks.loop(seconds=30)
-async def get_items():
-    """get_items task. Periodically runs through searches and adds them to
-    the queue to look for new items"""
-    await ebay.Search.get_items_list()
+def get_items_interval():
+    """Returns, in seconds, the interval every search would be fetched at
+    if the daily calls were split evenly between them"""
+    return items_interval
 
 
 def get_items_interval_str():
     """Returns get_items interval as a formatted string to display"""
-    return f"{get_items.minutes} minutes and {get_items.seconds} seconds"
+    minutes, seconds = divmod(items_interval, 60)
+    return f"{minutes} minutes and {seconds} seconds"
 
 
 def get_event_loop():
@@ -121,6 +272,12 @@ def get_bot():
     return bot
 
 
+def get_existing_channels(channel_ids):
+    """Returns the IDs of the given channels the bot can see. Every channel
+    is looked up once, however many searches it has."""
+    return {id for id in channel_ids if bot.get_channel(id)}
+
+
 def read_settings():
     """Gets the Discord bot token from the settings.yaml"""
     with open(utils.get_file_path("../settings.yaml")) as file:
@@ -132,32 +289,35 @@ def read_settings():
 
 
 def start_get_items():
-    """Starts the get_items task"""
-    get_items.start()
+    """Starts the scheduler that puts the searches in the queue
+    when they are due"""
+    scheduler.start()
 
 
 def update_get_items_interval():
-    """Updates the interval of the get_items task and checks
+    """Updates the even interval of the searches, the baseline the
+    scheduler adapts every search's interval from, and checks
     if limit of searches has been reached.
 
     Return Values:
     Boolean representing whether the search can be added.
     """
     seconds = 86400
-    seconds = math.ceil((seconds/ebay.get_max_calls())
+    # In a cluster, both are the share of this node
+    seconds = math.ceil((seconds/max(api_usage.settings["max_calls"], 1))
                         * ebay.get_total_search_cost())
 
     if max_interval and seconds > max_interval:
         return False
 
-    seconds = 30 if seconds < 30 else seconds
-
-    minutes, seconds = divmod(seconds, 60)
-    get_items.change_interval(minutes=minutes, seconds=seconds)
+    global items_interval
+    items_interval = 30 if seconds < 30 else seconds
     return True
 
 
 async def update_presence():
+    if not bot.is_ready():
+        return
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=f"{len(ebay.get_search_list())} searches | !help"))
 
 
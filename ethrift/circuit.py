@@ -0,0 +1,144 @@
+"""Circuit breakers of the Finding API calls of every ebay site.
+
+A site's breaker opens after a few calls in a row fail, or right away when
+eBay says the call limit was exceeded or asks for calls to slow down
+(error 10001, HTTP 429 or 503). While it is open, the scheduler holds the
+site's batches back and no calls are made to it. Once the backoff ends, a
+single call is let through as a probe: the breaker closes if it works and
+opens again with twice the backoff if it doesn't. Backoffs are jittered so
+the sites that failed together don't all come back together.
+Other sites keep being polled as usual.
+"""
+import random
+import time
+
+import finding
+
+
+FAILURE_THRESHOLD = 3  # Failed calls in a row that open the breaker
+BASE_DELAY = 5  # Seconds of the first backoff
+MAX_DELAY = 900  # Seconds of the longest backoff
+PROBE_TIMEOUT = 60  # Seconds after which a probe that never ended is retried
+RATE_LIMIT_STATUSES = (429, 503)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+breakers = {}
+
+
+class Breaker:
+    """State of the calls to a single ebay site"""
+    __slots__ = ('state', 'failures', 'opened', 'retry_at', 'probe_at')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0  # Failed calls in a row
+        self.opened = 0  # Times opened since the last successful call
+        self.retry_at = 0
+        self.probe_at = 0
+
+    def allow(self):
+        """Returns whether a call can be made now. Lets a single call
+        through as a probe once the backoff is over."""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN and now < self.retry_at:
+            return False
+        if self.state == HALF_OPEN and now - self.probe_at < PROBE_TIMEOUT:
+            return False
+        self.state = HALF_OPEN
+        self.probe_at = now
+        return True
+
+    def get_paused_until(self):
+        """Returns the monotonic time until which no calls can be made,
+        or None if calls can be made now"""
+        if self.state == OPEN:
+            return self.retry_at if time.monotonic() < self.retry_at else None
+        if self.state == HALF_OPEN:
+            # Checks again shortly whether the probe worked
+            return time.monotonic() + BASE_DELAY
+        return None
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+
+    def record_failure(self, rate_limited=False):
+        """Counts a failed call and opens the breaker when needed
+
+        Return Value:
+        Seconds of the backoff if the breaker was opened, otherwise None.
+        """
+        self.failures += 1
+        if self.state == OPEN:
+            return None  # Call made before the breaker opened
+        if self.state == CLOSED and not rate_limited \
+           and self.failures < FAILURE_THRESHOLD:
+            return None
+        delay = get_delay(self.opened)
+        self.state = OPEN
+        self.opened += 1
+        self.retry_at = time.monotonic() + delay
+        return delay
+
+
+def get_delay(opened):
+    """Returns the backoff of a breaker opened the given number of times
+    before, with half of it jittered"""
+    delay = min(BASE_DELAY * 2 ** opened, MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def get(site_id):
+    """Returns the breaker of the given site, creating it if needed"""
+    breaker = breakers.get(site_id)
+    if breaker is None:
+        breaker = breakers[site_id] = Breaker()
+    return breaker
+
+
+def allow(site_id):
+    """Returns whether a call to the given site can be made now"""
+    return get(site_id).allow()
+
+
+def get_paused_until(site_id):
+    """Returns the monotonic time until which the site's batches are held
+    back, or None if they can be polled"""
+    breaker = breakers.get(site_id)
+    return breaker.get_paused_until() if breaker else None
+
+
+def is_rate_limited(error):
+    """Returns whether the FindingError means the calls must slow down"""
+    return (finding.LIMIT_ERROR_ID in error.error_ids
+            or error.status in RATE_LIMIT_STATUSES)
+
+
+def is_site_failure(error):
+    """Returns whether the FindingError is the site's fault rather than
+    the request's, like a rate limit or a server error"""
+    return is_rate_limited(error) or (error.status or 0) >= 500
+
+
+def record_success(site_id):
+    get(site_id).record_success()
+
+
+def record_failure(site_id, rate_limited=False):
+    """Counts a failed call to the site, pausing it if the breaker opens"""
+    delay = get(site_id).record_failure(rate_limited)
+    if delay is not None:
+        print(f"Pausing calls to {site_id} for {delay:.0f} seconds"
+              f"{' after hitting the rate limit' if rate_limited else ''}")
+
+
+def get_open_sites():
+    """Returns the sites whose calls are paused or being probed"""
+    return [site_id for site_id, breaker in breakers.items()
+            if breaker.state != CLOSED]
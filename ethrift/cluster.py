@@ -0,0 +1,361 @@
+"""Partitioning of the queries between several ethrift nodes.
+
+When the cluster is enabled, every node shares a coordination database
+(SQLite, on a disk all the nodes can reach) and the searches storage.
+Queries are spread over a fixed number of partitions by the hash of their
+canonical key. Every node holds leases on an even share of the partitions
+and only fetches the queries in them. Leases are renewed with every
+heartbeat, so the partitions of a node that stops are taken over by the
+others once its leases expire, and nodes over their share release
+partitions when new nodes join.
+
+A single node, the gateway, is connected to Discord. It handles the
+commands and sends the items found by every node, which the other nodes
+write to an outbox table in the coordination database. The other nodes
+pick up the searches added or removed on the gateway from the storage.
+The gateway can't tell whether the node fetching a new search has room
+for it, so that node writes the searches it had to leave out to a
+rejected table and the gateway removes them.
+
+The coordination database is only used from a dedicated thread, since its
+calls can wait for the locks held by other nodes.
+"""
+import asyncio
+import concurrent.futures
+import json
+import math
+import socket
+import sqlite3
+import time
+import zlib
+
+import discord
+
+import utils
+import data
+import ebay
+import dispatcher
+import matcher
+import usage
+
+
+DELIVER_INTERVAL = 1  # Seconds between writes or reads of the outbox
+OUTBOX_BATCH = 1000  # Items read from the outbox at a time
+
+settings = {"enabled": False, "node": None, "gateway": True,
+            "path": "../cluster.db", "partitions": 64, "lease": 10,
+            "heartbeat": 2}
+
+connection = None
+executor = None  # Thread of the coordination database
+partitions = set()
+outbox = []
+rejected = []
+tasks = []
+searches_version = None
+
+
+def read_settings(_settings):
+    """Initializes the settings from the cluster section of settings.yaml"""
+    settings.update(_settings or {})
+    if settings["enabled"]:
+        # Every node counts its own calls against its share of the limit
+        usage.settings["path"] = f"../usage-{get_node()}.json"
+
+
+def get_node():
+    """Returns the name of this node"""
+    return settings["node"] or socket.gethostname()
+
+
+def is_gateway():
+    """Returns whether this node is connected to Discord"""
+    return not settings["enabled"] or settings["gateway"]
+
+
+def get_partition(query):
+    """Returns the partition of the query"""
+    key = query.get_cursor_key().encode()
+    return zlib.crc32(key) % settings["partitions"]
+
+
+def owns(query):
+    """Returns whether this node fetches the query"""
+    return not settings["enabled"] or get_partition(query) in partitions
+
+
+def run(function, *args):
+    """Runs the function on the thread of the coordination database
+    without blocking the event loop"""
+    return asyncio.get_event_loop().run_in_executor(executor, function, *args)
+
+
+def connect():
+    """Opens the coordination database and creates its tables"""
+    global connection
+    connection = sqlite3.connect(utils.get_file_path(settings["path"]),
+                                 isolation_level=None, timeout=30,
+                                 check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS nodes ("
+                       "node TEXT PRIMARY KEY,"
+                       "heartbeat REAL NOT NULL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS leases ("
+                       "partition INTEGER PRIMARY KEY,"
+                       "node TEXT,"
+                       "expires REAL NOT NULL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                       "id INTEGER PRIMARY KEY,"
+                       "channel_id INTEGER NOT NULL,"
+                       "embed TEXT NOT NULL,"
+                       "start_time TEXT)")
+    connection.execute("CREATE TABLE IF NOT EXISTS rejected ("
+                       "search_id INTEGER PRIMARY KEY)")
+    connection.executemany("INSERT OR IGNORE INTO leases VALUES (?, NULL, 0)",
+                           [(p,) for p in range(settings["partitions"])])
+
+
+def renew():
+    """Sends the heartbeat of the node, renews its leases and takes or
+    releases partitions to keep an even share of them
+
+    Return Value:
+    Set of the partitions leased by the node.
+    """
+    node = get_node()
+    now = time.time()
+    expires = now + settings["lease"]
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.execute("INSERT OR REPLACE INTO nodes VALUES (?, ?)",
+                           (node, now))
+        connection.execute("DELETE FROM nodes WHERE heartbeat < ?",
+                           (now - settings["lease"],))
+        nodes = connection.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+        share = math.ceil(settings["partitions"] / max(nodes, 1))
+
+        owned = [p for p, in connection.execute(
+            "SELECT partition FROM leases WHERE node = ? AND expires > ? "
+            "ORDER BY partition", (node, now))]
+        released = owned[share:]
+        owned = owned[:share]
+        if len(owned) < share:
+            owned += [p for p, in connection.execute(
+                "SELECT partition FROM leases WHERE expires <= ? "
+                "ORDER BY partition LIMIT ?", (now, share - len(owned)))]
+
+        connection.executemany(
+            "UPDATE leases SET node = NULL, expires = 0 WHERE partition = ?",
+            [(p,) for p in released])
+        connection.executemany(
+            "UPDATE leases SET node = ?, expires = ? WHERE partition = ?",
+            [(node, expires, p) for p in owned])
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    return set(owned)
+
+
+def apply(owned):
+    """Starts fetching the queries of the partitions the node got and stops
+    fetching the ones of the partitions it lost"""
+    global partitions
+    gained, lost = owned - partitions, partitions - owned
+    if not gained and not lost:
+        return
+    partitions = owned
+
+    cursors = data.load_cursors() if gained else {}
+    for query in list(ebay.query_list.values()):
+        partition = get_partition(query)
+        if partition in lost and query.batch:
+            ebay.Batch.remove_query(query)
+        elif partition in gained and not query.batch:
+            cursor = cursors.get(query.get_cursor_key())
+            if cursor:
+                query.restore_cursor(cursor)
+            ebay.Batch.add_query(query)
+
+    # The node's share of the daily calls follows its share of the partitions
+    usage.settings["max_calls"] = math.floor(
+        ebay.get_max_calls() * len(partitions) / settings["partitions"])
+
+
+def deliver(channel_id, embed, start_time=None):
+    """Queues the embed to be written to the outbox, for the gateway to
+    send it"""
+    outbox.append((channel_id, json.dumps(embed.to_dict()),
+                   utils.datetime_to_iso(start_time) if start_time else None))
+
+
+def take_outbox():
+    """Returns the embeds queued to be written to the outbox"""
+    global outbox
+    rows, outbox = outbox, []
+    return rows
+
+
+def write_outbox(rows):
+    """Writes the given embeds to the outbox"""
+    if not rows:
+        return
+    connection.executemany(
+        "INSERT INTO outbox (channel_id, embed, start_time) VALUES (?, ?, ?)",
+        rows)
+
+
+def read_outbox():
+    """Returns the embeds written to the outbox by the other nodes and
+    removes them from it"""
+    rows = connection.execute(
+        "SELECT id, channel_id, embed, start_time FROM outbox "
+        "ORDER BY id LIMIT ?",
+        (OUTBOX_BATCH,)).fetchall()
+    if rows:
+        connection.execute("DELETE FROM outbox WHERE id <= ?", (rows[-1][0],))
+    return rows
+
+
+def send_outbox(rows):
+    """Sends the embeds read from the outbox"""
+    for _, channel_id, embed, start_time in rows:
+        dispatcher.send(channel_id, discord.Embed.from_dict(json.loads(embed)),
+                        utils.iso_to_datetime(start_time) if start_time else None)
+
+
+def reject(search):
+    """Queues the search to be written to the rejected searches, for the
+    gateway to remove it"""
+    rejected.append((search.id,))
+
+
+def take_rejected():
+    """Returns the searches queued to be written to the rejected searches"""
+    global rejected
+    rows, rejected = rejected, []
+    return rows
+
+
+def write_rejected(rows):
+    """Writes the given searches to the rejected searches"""
+    if not rows:
+        return
+    connection.executemany(
+        "INSERT OR IGNORE INTO rejected (search_id) VALUES (?)", rows)
+
+
+def read_rejected():
+    """Returns the IDs of the searches rejected by the other nodes and
+    removes them from the rejected searches"""
+    ids = {search_id for search_id, in connection.execute(
+        "SELECT search_id FROM rejected")}
+    connection.executemany("DELETE FROM rejected WHERE search_id = ?",
+                           [(search_id,) for search_id in ids])
+    return ids
+
+
+async def sync_searches():
+    """Adds and removes the searches added and removed on the gateway since
+    the last sync"""
+    global searches_version
+    version = data.get_version()
+    if version is not None and version == searches_version:
+        return
+    searches_version = version
+
+    records = {r['id']: r for r in data.load_searches()}
+    for search in list(ebay.search_list):
+        record = records.pop(search.id, None)
+        if record is None:
+            search.remove_from_index()
+            ebay.Query.unsubscribe(search)
+            search.update_rules(replace=True)
+            continue
+        rules = matcher.Rules(record['include'], record['exclude'])
+        current = search.rules or matcher.Rules()
+        if (rules.include, rules.exclude) != (current.include, current.exclude):
+            search.update_rules(rules.include, rules.exclude, replace=True)
+    ebay.Search.add_many(records.values())
+
+
+async def heartbeat():
+    """Renews the node's leases and follows the changes of the partitions
+    and of the searches"""
+    while True:
+        await asyncio.sleep(settings["heartbeat"])
+        try:
+            # Cursors are saved first so the nodes taking over partitions
+            # continue where this node stopped
+            ebay.Search.save_cursors()
+            apply(await run(renew))
+            if not is_gateway():
+                await sync_searches()
+                await run(write_rejected, take_rejected())
+            else:
+                ids = await run(read_rejected)
+                if ids:
+                    await ebay.Search.remove_rejected(ids)
+        except Exception as e:
+            print(f"Exception in cluster heartbeat: {e}")
+
+
+async def run_outbox():
+    """Writes the items found to the outbox, or sends the items in the
+    outbox on the gateway"""
+    while True:
+        await asyncio.sleep(DELIVER_INTERVAL)
+        try:
+            if is_gateway():
+                send_outbox(await run(read_outbox))
+            else:
+                await run(write_outbox, take_outbox())
+        except sqlite3.Error as e:
+            print(f"Exception in cluster outbox: {e}")
+
+
+def start():
+    """Leases the node's first partitions and starts the heartbeat.
+    Must be called from the event loop before the searches are read,
+    which wait for the leases."""
+    global executor
+    if not settings["enabled"] or tasks:
+        return
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="Cluster")
+    executor.submit(connect).result()
+    apply(executor.submit(renew).result())
+    tasks.append(asyncio.ensure_future(heartbeat()))
+    tasks.append(asyncio.ensure_future(run_outbox()))
+
+
+def release():
+    """Releases the node's leases and removes it from the nodes"""
+    connection.execute("UPDATE leases SET node = NULL, expires = 0 "
+                       "WHERE node = ?", (get_node(),))
+    connection.execute("DELETE FROM nodes WHERE node = ?", (get_node(),))
+
+
+def stop():
+    """Writes the items left in the outbox and releases the node's leases"""
+    if connection is None:
+        return
+    executor.submit(write_outbox, take_outbox()).result()
+    executor.submit(write_rejected, take_rejected()).result()
+    executor.submit(release).result()
+
+
+async def run_worker():
+    """Runs a node that is not connected to Discord"""
+    await ebay.Search.read_searches()
+    await asyncio.gather(*tasks)
+
+
+def main():
+    """Runs the node until it is stopped. Used instead of bot.main by the
+    nodes that are not the gateway."""
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(run_worker())
+    except KeyboardInterrupt:
+        pass
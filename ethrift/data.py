@@ -1,54 +1,503 @@
-import requests
+import json
+import sqlite3
 import threading
-import yaml
+import time
 import utils
 
+from datetime import datetime
 
-MAX_THREADS = 5
+
+DEBOUNCE = 2  # Seconds a save waits for newer data before being written
+RETRY_DELAY = 30  # Seconds before retrying a save that failed
 
 jsonbin = {"bin-id": None, "secret-key": None}
+settings = {"backend": "sqlite", "path": "../ethrift.db", "export": False}
 
-current_threads = 0
+storage = None
 
-with open(utils.get_file_path("../settings.yaml")) as file:
-    settings = yaml.safe_load(file)
-    jsonbin["bin-id"] = settings["jsonbin"]["bin-id"]
-    jsonbin["secret-key"] = settings["jsonbin"]["secret-key"]
 
+def read_settings(_settings):
+    """Initializes the settings from the jsonbin and storage sections of
+    settings.yaml"""
+    if _settings.get("jsonbin"):
+        jsonbin["bin-id"] = _settings["jsonbin"].get("bin-id")
+        jsonbin["secret-key"] = _settings["jsonbin"].get("secret-key")
+    settings.update(_settings.get("storage") or {})
 
-def __save(json_data):
-    global current_threads
-    for _ in range(3):  # Tries 3 times
+
+class Storage:
+    """Interface of the backends the searches are stored in.
+
+    Searches are stored as records like {'id': 1, 'url': '...',
+    'channel_id': 719950000000000000, 'include': [], 'exclude': []}.
+    The id is given by the backend when the search is added. include and
+    exclude are the terms of the title rules of the search.
+    """
+
+    def load(self):
+        """Returns the list of all stored search records"""
+        raise NotImplementedError
+
+    def add(self, url, channel_id):
+        """Stores a new search and returns its id"""
+        raise NotImplementedError
+
+    def delete(self, ids):
+        """Removes the searches with the given ids"""
+        raise NotImplementedError
+
+    def set_rules(self, id, include, exclude):
+        """Replaces the title rules of the search with the given id"""
+        raise NotImplementedError
+
+    def get_version(self):
+        """Returns a value that changes whenever searches or rules are
+        added or removed, or None if the backend can't tell"""
+        return None
+
+    def load_cursors(self):
+        """Returns the saved cursors of every query as a dictionary like
+        {key: {'newest_start_time': '...', 'seen': ['1234', ...]}}"""
+        return {}
+
+    def save_cursors(self, cursors):
+        """Saves the cursors of the given queries, in the same format
+        load_cursors returns them"""
+
+    def delete_cursors(self, keys):
+        """Removes the cursors of the given queries"""
+
+    def get_exported_version(self):
+        """Returns the version of the searches last exported to JSONBin,
+        or None if they were never exported"""
+        return None
+
+    def set_exported_version(self, version):
+        """Saves the version of the searches exported to JSONBin"""
+
+
+class SQLiteStorage(Storage):
+    """Stores the searches in a local SQLite database.
+
+    Every add or delete only writes the rows that changed. The database
+    uses write-ahead logging so writes don't block reads.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(utils.get_file_path(path),
+                                          check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS searches ("
+                                "id INTEGER PRIMARY KEY,"
+                                "url TEXT NOT NULL,"
+                                "channel_id INTEGER NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS rules ("
+                                "search_id INTEGER NOT NULL,"
+                                "kind TEXT NOT NULL,"
+                                "term TEXT NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS rules_search_id "
+                                "ON rules (search_id)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cursors ("
+                                "key TEXT PRIMARY KEY,"
+                                "newest_start_time TEXT NOT NULL,"
+                                "seen TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state ("
+                                "key TEXT PRIMARY KEY,"
+                                "value TEXT NOT NULL)")
+        self.connection.commit()
+
+    def load(self):
+        rows = self.connection.execute(
+            "SELECT id, url, channel_id FROM searches ORDER BY id").fetchall()
+        records = {id: {'id': id, 'url': url, 'channel_id': channel_id,
+                        'include': [], 'exclude': []}
+                   for id, url, channel_id in rows}
+        for search_id, kind, term in self.connection.execute(
+                "SELECT search_id, kind, term FROM rules ORDER BY rowid"):
+            if search_id in records and kind in ('include', 'exclude'):
+                records[search_id][kind].append(term)
+        return list(records.values())
+
+    def add(self, url, channel_id):
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO searches (url, channel_id) VALUES (?, ?)",
+                (url, channel_id))
+        return cursor.lastrowid
+
+    def add_many(self, records):
+        """Stores many searches in a single transaction. Used to import
+        searches from other backends."""
+        with self.connection:
+            for r in records:
+                cursor = self.connection.execute(
+                    "INSERT INTO searches (url, channel_id) VALUES (?, ?)",
+                    (r['url'], int(r['channel_id'])))
+                self.insert_rules(cursor.lastrowid, r.get('include') or [],
+                                  r.get('exclude') or [])
+
+    def delete(self, ids):
+        with self.connection:
+            self.connection.executemany("DELETE FROM searches WHERE id = ?",
+                                        [(id,) for id in ids])
+            self.connection.executemany("DELETE FROM rules WHERE search_id = ?",
+                                        [(id,) for id in ids])
+
+    def set_rules(self, id, include, exclude):
+        with self.connection:
+            self.connection.execute("DELETE FROM rules WHERE search_id = ?",
+                                    (id,))
+            self.insert_rules(id, include, exclude)
+
+    def get_version(self):
+        # Row ids only grow, so replaced rows change the sums too
+        return self.connection.execute(
+            "SELECT (SELECT COUNT(*) || ':' || TOTAL(id) FROM searches), "
+            "(SELECT COUNT(*) || ':' || TOTAL(rowid) FROM rules)").fetchone()
+
+    def insert_rules(self, id, include, exclude):
+        self.connection.executemany(
+            "INSERT INTO rules (search_id, kind, term) VALUES (?, ?, ?)",
+            [(id, 'include', t) for t in include]
+            + [(id, 'exclude', t) for t in exclude])
+
+    def load_cursors(self):
+        rows = self.connection.execute(
+            "SELECT key, newest_start_time, seen FROM cursors").fetchall()
+        return {key: {'newest_start_time': newest_start_time,
+                      'seen': seen.split(',') if seen else []}
+                for key, newest_start_time, seen in rows}
+
+    def save_cursors(self, cursors):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cursors (key, newest_start_time, seen)"
+                " VALUES (?, ?, ?)",
+                [(key, c['newest_start_time'], ','.join(c['seen']))
+                 for key, c in cursors.items()])
+
+    def delete_cursors(self, keys):
+        with self.connection:
+            self.connection.executemany("DELETE FROM cursors WHERE key = ?",
+                                        [(key,) for key in keys])
+
+    def get_exported_version(self):
+        row = self.connection.execute(
+            "SELECT value FROM state WHERE key = 'exported_version'").fetchone()
+        return tuple(json.loads(row[0])) if row else None
+
+    def set_exported_version(self, version):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO state (key, value) "
+                "VALUES ('exported_version', ?)", (json.dumps(version),))
+
+
+class JSONBinStorage(Storage):
+    """Stores the searches as a single JSON document in JSONBin.
+
+    JSONBin can't update parts of a document, so every change saves the
+    whole document again. Cursors are not saved, since they change on
+    every poll.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.next_id = 1
+
+    def load(self):
         try:
-            current_threads += 1
+            data_s = json.loads(read())
+            self.records = [{'id': n, 'url': q['url'],
+                             'channel_id': int(q['channel_id']),
+                             'include': q.get('include', []),
+                             'exclude': q.get('exclude', [])}
+                            for n, q in enumerate(data_s['searches'], 1)]
+        except (KeyError, TypeError, ValueError):
+            self.records = []
+        self.next_id = len(self.records) + 1
+        return list(self.records)
 
-            bin_id = jsonbin.get("bin-id")
-            url = f"https://api.jsonbin.io/b/{bin_id}"
-            headers = {'Content-Type': 'application/json',
-                       'secret-key': jsonbin.get("secret-key"),
-                       'versioning': 'false'}
+    def add(self, url, channel_id):
+        id = self.next_id
+        self.next_id += 1
+        self.records.append({'id': id, 'url': url, 'channel_id': channel_id,
+                             'include': [], 'exclude': []})
+        save(get_document(self.records))
+        return id
+
+    def delete(self, ids):
+        ids = set(ids)
+        self.records = [r for r in self.records if r['id'] not in ids]
+        save(get_document(self.records))
+
+    def set_rules(self, id, include, exclude):
+        for record in self.records:
+            if record['id'] == id:
+                record.update(include=list(include), exclude=list(exclude))
+        save(get_document(self.records))
+
+
+def get_document(records):
+    """Returns the search records as the JSON document saved to JSONBin"""
+    searches = []
+    for r in records:
+        search = {'url': r['url'], 'channel_id': f"{r['channel_id']}"}
+        for kind in ('include', 'exclude'):
+            if r.get(kind):
+                search[kind] = list(r[kind])
+        searches.append(search)
+    return {'searches': searches}
+
+
+def get_storage():
+    """Returns the storage backend selected in the settings"""
+    global storage
+    if storage is None:
+        if settings.get("backend") == "jsonbin":
+            storage = JSONBinStorage()
+        else:
+            storage = SQLiteStorage(settings.get("path"))
+    return storage
+
+
+def load_searches():
+    """Returns all stored search records.
+
+    The first time the SQLite backend is used, the searches saved in
+    JSONBin, if any, are imported into it.
+    """
+    _storage = get_storage()
+    records = _storage.load()
+    if not records and isinstance(_storage, SQLiteStorage) \
+       and jsonbin.get("bin-id"):
+        imported = JSONBinStorage().load()
+        if imported:
+            _storage.add_many(imported)
+            records = _storage.load()
+    return records
 
+
+def add_search(url, channel_id):
+    """Stores a new search and returns its id"""
+    return get_storage().add(url, channel_id)
+
+
+def delete_searches(ids):
+    """Removes the stored searches with the given ids"""
+    get_storage().delete(ids)
+
+
+def set_rules(id, include, exclude):
+    """Replaces the title rules of the stored search with the given id"""
+    get_storage().set_rules(id, include, exclude)
+
+
+def get_version():
+    """Returns a value that changes whenever the stored searches change"""
+    return get_storage().get_version()
+
+
+def load_cursors():
+    """Returns the saved cursors of every query"""
+    return get_storage().load_cursors()
+
+
+def save_cursors(cursors):
+    """Saves the cursors of the given queries"""
+    if cursors:
+        get_storage().save_cursors(cursors)
+
+
+def delete_cursors(keys):
+    """Removes the cursors of the given queries"""
+    get_storage().delete_cursors(keys)
+
+
+def is_exported():
+    """Returns whether JSONBin is used as an export target for another
+    backend"""
+    return bool(settings.get("export")) \
+        and not isinstance(get_storage(), JSONBinStorage)
+
+
+def export():
+    """Saves every search to JSONBin when it is used as an export target
+    for another backend and the searches changed since the last export.
+    Exporting reads every search, so it is only done on start, on shutdown
+    and with the !storage export command, not after every change.
+
+    The version of the exported searches is saved with them once JSONBin
+    has them, so exports lost to a crash, or never made before exporting
+    was enabled, are made on the next start.
+
+    Return Value:
+    Boolean representing whether an export was queued.
+    """
+    if not is_exported():
+        return False
+    _storage = get_storage()
+    version = _storage.get_version()
+    if version is not None and version == _storage.get_exported_version():
+        return False
+    save(get_document(_storage.load()),
+         lambda: _storage.set_exported_version(version))
+    return True
+
+
+class Writer:
+    """Single background thread that saves the JSONBin document.
+
+    Saves are debounced: a burst of changes is written once, after no
+    newer document has been queued for DEBOUNCE seconds. Only the newest
+    document is kept, so older ones that were not written yet are dropped
+    instead of being sent for nothing.
+    """
+
+    def __init__(self, write):
+        self.write = write
+        self.condition = threading.Condition()
+        self.thread = None
+        self.pending = None
+        self.on_written = None  # Called once the pending document is written
+        self.changed_at = 0
+        self.queued_at = None  # When the oldest unwritten document was queued
+        self.written_at = None
+        self.closed = False
+
+    def put(self, document, on_written=None):
+        """Queues the document to be written, replacing any document
+        that was not written yet"""
+        with self.condition:
+            now = time.monotonic()
+            self.pending = document
+            self.on_written = on_written
+            self.changed_at = now
+            self.queued_at = self.queued_at or now
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="Data",
+                                               daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def take(self):
+        """Waits for a document to be queued and for the changes to settle.
+
+        Return Values:
+        The newest document, or None once the writer is closed.
+        Function to call once it is written, or None.
+        """
+        with self.condition:
+            while self.pending is None and not self.closed:
+                self.condition.wait()
+            while self.pending is not None and not self.closed:
+                remaining = self.changed_at + DEBOUNCE - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            document, self.pending = self.pending, None
+            return document, self.on_written
+
+    def run(self):
+        while True:
+            document, on_written = self.take()
+            if document is None:
+                return
+
+            written = self.write(document)
+            if written and on_written:
+                on_written()
+            with self.condition:
+                if written:
+                    self.written_at = datetime.now()
+                    if self.pending is None:
+                        self.queued_at = None
+                    continue
+                if self.pending is None:
+                    self.pending = document  # Retried unless a newer one comes
+                    self.on_written = on_written
+                if not self.closed:
+                    self.condition.wait(RETRY_DELAY)
+
+    def flush(self, timeout=None):
+        """Writes the pending document, if any, and stops the writer"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            thread, document, self.pending = self.thread, self.pending, None
+            on_written = self.on_written
+        if thread:
+            thread.join(timeout)
+        if document is not None and self.write(document):
+            self.written_at = datetime.now()
+            self.queued_at = None
+            if on_written:
+                on_written()
+
+    def get_lag(self):
+        """Returns the seconds the oldest unwritten document has been
+        waiting to be written"""
+        queued_at = self.queued_at
+        return time.monotonic() - queued_at if queued_at else 0
+
+
+def write(json_data):
+    """Saves the document to JSONBin.
+
+    Return Value:
+    Boolean representing whether the document was saved.
+    """
+    import requests  # Only needed by the JSONBin backend
+
+    bin_id = jsonbin.get("bin-id")
+    url = f"https://api.jsonbin.io/b/{bin_id}"
+    headers = {'Content-Type': 'application/json',
+               'secret-key': jsonbin.get("secret-key"),
+               'versioning': 'false'}
+
+    for _ in range(3):  # Tries 3 times
+        try:
             res = requests.put(url, json=json_data,
                                headers=headers, timeout=10)
             if res.status_code == 200:
-                break
+                return True
         except requests.exceptions.ReadTimeout:
             pass
         except Exception as exception:
             print(f"Unable to save data to JSONBIN\nException: {exception}")
-            return ""
+            return False
+    return False
+
+
+writer = Writer(write)
 
-    current_threads -= 1
 
+def save(json_data, on_written=None):
+    """Queues the document to be saved to JSONBin by the writer thread,
+    calling on_written once it is saved"""
+    writer.put(json_data, on_written)
 
-def save(json_data):
-    if current_threads < MAX_THREADS:
-        save_thread = threading.Thread(target=__save, args=(json_data,),
-                                       name="Data")
-        save_thread.start()
+
+def flush(timeout=10):
+    """Writes the document waiting to be saved, if any. Called on shutdown."""
+    writer.flush(timeout)
+
+
+def get_writer_stats():
+    """Returns the state of the writer
+
+    Return Value:
+    Dictionary with the seconds the oldest unwritten document has been
+    waiting and the time of the last successful write.
+    Example: {'lag': 1.5, 'written_at': datetime(2020, 8, 1, 10, 0, 0)}
+    """
+    return {"lag": writer.get_lag(), "written_at": writer.written_at}
 
 
 def read():
+    import requests  # Only needed by the JSONBin backend
+
     for _ in range(3):  # Tries 3 times
         try:
             bin_id = jsonbin.get("bin-id")
@@ -0,0 +1,134 @@
+"""Sends the embeds of new items to the Discord channels.
+
+Every channel has its own outbound queue. Queued embeds are packed up to
+MAX_EMBEDS per message and messages are spaced to stay within the
+channel's rate limit bucket, instead of waiting for 429 responses.
+Fetch workers only enqueue embeds and never wait for Discord.
+Messages lost on the way to Discord, to a connection error or a timeout,
+are sent again.
+"""
+import asyncio
+import time
+import statistics
+import aiohttp
+import discord
+
+from collections import deque
+from discord.http import Route
+
+import bot
+import cluster
+import metrics
+import tracing
+
+
+MAX_EMBEDS = 10  # Maximum number of embeds per message
+LATENCY_SAMPLES = 100
+RETRY_DELAY = 5  # Seconds before resending a message that never got to Discord
+
+# Discord allows 5 messages every 5 seconds per channel
+settings = {"rate": 5, "per": 5}
+
+channels = {}
+
+
+class Channel:
+    """Outbound queue of a Discord channel"""
+    __slots__ = ('id', 'queue', 'task', 'sent', 'sent_times', 'latencies')
+
+    def __init__(self, id):
+        self.id = id
+        self.queue = deque()  # Embeds and the start time of their items
+        self.task = None
+        self.sent = 0
+        self.sent_times = deque(maxlen=settings.get("rate"))
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    async def wait_for_bucket(self):
+        """Waits until a message can be sent without going over the
+        channel's rate limit"""
+        if len(self.sent_times) < self.sent_times.maxlen:
+            return
+        wait = self.sent_times[0] + settings.get("per") - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def run(self):
+        """Sends the queued embeds until the queue is empty"""
+        try:
+            while self.queue:
+                await self.wait_for_bucket()
+                entries = [self.queue.popleft()
+                           for _ in range(min(MAX_EMBEDS, len(self.queue)))]
+                embeds = [embed for embed, _ in entries]
+                start = time.perf_counter()
+                self.sent_times.append(time.monotonic())
+                try:
+                    with tracing.span("send", channel=self.id,
+                                      embeds=len(embeds)):
+                        await send_message(self.id, embeds)
+                    self.sent += len(embeds)
+                    if metrics.enabled:
+                        for _, start_time in entries:
+                            metrics.observe_sent(start_time)
+                except (discord.NotFound, discord.Forbidden):
+                    # Channel was deleted or the bot can no longer send to it
+                    self.queue.clear()
+                except discord.HTTPException as e:
+                    print(f"Exception sending items to {self.id}: {e}")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # The embeds are sent again, ahead of the newer ones
+                    print(f"Exception sending items to {self.id}: {e!r}")
+                    self.queue.extendleft(reversed(entries))
+                    await asyncio.sleep(RETRY_DELAY)
+                    continue
+                self.latencies.append(time.perf_counter() - start)
+        finally:
+            self.task = None
+
+
+async def send_message(channel_id, embeds):
+    """Sends a single message with all the given embeds.
+
+    Messageable.send only takes one embed, so the message is created
+    through the HTTP client directly. It still goes through discord.py's
+    own rate limit handling.
+    """
+    route = Route('POST', '/channels/{channel_id}/messages',
+                  channel_id=channel_id)
+    await bot.get_bot().http.request(
+        route, json={'embeds': [embed.to_dict() for embed in embeds]})
+
+
+def send(channel_id, embed, start_time=None):
+    """Puts the embed in the channel's queue and starts sending the queue
+    if it is not being sent already. Does not wait for Discord.
+    Nodes that are not connected to Discord leave it for the gateway.
+
+    Keyword Arguments:
+        channel_id         -- ID of the Discord channel
+        embed              -- Discord embed of the item
+        start_time         -- UTC datetime the item was listed at, if known
+    """
+    if not cluster.is_gateway():
+        cluster.deliver(channel_id, embed, start_time)
+        return
+    channel = channels.get(channel_id)
+    if channel is None:
+        channel = channels[channel_id] = Channel(channel_id)
+    channel.queue.append((embed, start_time))
+    if channel.task is None:
+        channel.task = asyncio.ensure_future(channel.run())
+
+
+def get_stats():
+    """Returns the queue depth, number of embeds sent and median send
+    latency in milliseconds of every channel
+
+    Example: {719950000000000000: {'queued': 12, 'sent': 240, 'p50': 180.3}}
+    """
+    return {channel_id: {"queued": len(channel.queue),
+                         "sent": channel.sent,
+                         "p50": statistics.median(channel.latencies)*1000
+                         if channel.latencies else 0}
+            for channel_id, channel in channels.items()}
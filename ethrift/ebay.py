@@ -1,36 +1,63 @@
 # External modules
-import json
-import ast
 import urllib.parse as urlparse
-import threading
-import time
 import yaml
 import discord
 import asyncio
+import aiohttp
+import json
 import math
+import re
+import sys
+import time
 
-from ebaysdk.finding import Connection as Finding
-from ebaysdk.exception import ConnectionError
 from urllib.parse import parse_qs
 from decimal import Decimal
-from datetime import datetime, timedelta
+from datetime import datetime
 
 # Internal modules
 import utils
 import data
 import mapping
+import finding
+import dispatcher
+import scheduler
+import matcher
+import cluster
+import extraction
+import metrics
+import tracing
+import circuit
+import seen
+import usage
 import bot
 
 
 MAX_CHARACTERS = 1024
-MAX_THREADS = 20
-
-settings = {"domain": None, "appid": None, "version": None, "max_calls": 5000}
-
-queue = []
-threads = []
-search_list = []
+MAX_KEYWORDS_LENGTH = 350  # Maximum length of the keywords in a request
+CATCH_UP_SHARE = 0.1  # Share of the remaining calls used to catch up after a restart
+MAX_CATCH_UP_PAGES = 10  # Pages requested per batch when catching up
+CATCH_UP_DELAY = 2  # Seconds between the catch up requests of a batch
+MIN_ENTRIES_PER_PAGE = 10  # Smallest page requested for quiet batches
+PAGE_SIZE_FACTOR = 3  # Times the new items expected per poll a page has room for
+MAX_FOLLOW_PAGES = 5  # Pages requested per poll when every item is new
+FOLLOW_SHARE = 0.1  # Share of the daily calls that can be used following pages
+CURSORS_SAVE_INTERVAL = 30  # Seconds between saves of the query cursors
+
+settings = {"max_calls": 5000, "concurrency": 20, "batch_size": 10}
+
+queue = None
+workers = []
+search_list = {}  # Every search, used as an ordered set
+channel_searches = {}  # Searches of every channel in the order they were added
+query_list = {}
+batch_list = {}  # Every batch, used as an ordered set
+batch_groups = {}  # Batches with room left of every site and filters
 total_search_cost = 0
+saved_cursors = {}
+changed_queries = set()
+cursors_saved_at = 0
+catch_up_calls = 0
+follow_calls = {"day": None, "calls": 0}  # Calls used following pages today
 
 
 class Filters(dict):
@@ -38,32 +65,13 @@ class Filters(dict):
     search filters
     """
 
-    def __init__(self, *arg, **kw):
-        super(Filters, self).__init__(*arg, **kw)
-
-    def __setitem__(self, key, item):
-        self.__dict__[key] = item
-
-    def __getitem__(self, key):
-        return self.__dict__[key]
-
-    def get(self, key):
-        return self.__dict__.get(key)
-
-    def __iter__(self):
-        return iter(self.__dict__)
-
-    def __len__(self):
-        return len(self.__dict__)
+    __slots__ = ()
 
     def copy(self):
-        """Overwrite dict's copy function
-        to copy and return the dict part of the object.
+        """Overwrite dict's copy function to return a Filters object.
         Otherwise it would return a dict instead of a Filter object
         """
-        aux = Filters()
-        aux.__dict__ = self.__dict__.copy()
-        return aux
+        return Filters(self)
 
     def iterate_locatedin(self):
         """Iterates through the LocatedIn countries list
@@ -123,23 +131,6 @@ class Filters(dict):
 
         return result_list, self
 
-    @staticmethod
-    def filter_response_items(search, item_response):
-        """Verify if item matches search filters
-
-        Some filters like items accepting best offers can't be set specifically
-        in the request and need to be checked per item in the response
-        """
-
-        parsed = urlparse.urlparse(search.url)
-        query = urlparse.parse_qs(parsed.query)
-
-        if query.get('LH_BO') \
-           and item_response['listingInfo']['bestOfferEnabled'] == "false":
-            return False
-
-        return True
-
     @staticmethod
     def map_located_in_filter(global_id, query):
         """Gets the item location value from the query string and maps it to a valid
@@ -178,6 +169,14 @@ class Filters(dict):
         if listing_type:
             filters['ListingType'] = listing_type
 
+        # Also checked on the items, see extraction.Predicates
+        if query.get('_ssn'):
+            filters['Seller'] = [query.get('_ssn')[0].strip()]
+        if query.get('LH_FS'):
+            filters['FreeShippingOnly'] = 'true'
+        if query.get('LH_BO'):
+            filters['BestOfferOnly'] = 'true'
+
         located_in = Filters.map_located_in_filter(ebay_site, query)
         if located_in:
             filters['LocatedIn'] = located_in
@@ -186,6 +185,9 @@ class Filters(dict):
 
 
 class Item:
+    __slots__ = ('id', 'title', 'price', 'url', 'location', 'condition',
+                 'thumbnail', 'start_time')
+
     def __init__(self, id, title, price, url, location, condition,
                  thumbnail=None, start_time=None):
         self.id = id
@@ -195,14 +197,13 @@ class Item:
         self.location = location
         self.condition = condition
         self.thumbnail = thumbnail
-        self.start_time = start_time
-        self.start_time_f = utils.iso_to_datetime(self.start_time)
+        self.start_time = utils.iso_to_datetime(start_time)
 
     def __eq__(self, other):
         return self.url == other.url
 
-    def display(self, channel):
-        """Displays the item as a Discord embed in the given channel"""
+    def get_embed(self):
+        """Returns the item as a Discord embed"""
         Decimal(f"{self.price}").quantize(Decimal("0.00"))
         embed = discord.Embed(
             title=f"{self.title}", url=f"{self.url}", description="", color=0xfaa61a)
@@ -212,27 +213,34 @@ class Item:
                         value=f"`{self.location}`", inline=True)
         embed.add_field(name="Condition",
                         value=f"`{self.condition}`", inline=True)
-        utils.async_from_sync(bot.get_event_loop(),
-                              channel.send, embed=embed)
+        return embed
+
+    def display(self, channel_ids):
+        """Queues the item to be displayed as a Discord embed in the
+        given channels"""
+        embed = self.get_embed()
+        for channel_id in channel_ids:
+            dispatcher.send(channel_id, embed, self.start_time)
 
     @staticmethod
     def item_from_data(i):
         """Returns an Item object with the info from the ebay API response.
 
         Keyword Arguments:
-            i              -- indexes of the searches to remove
+            i              -- item fields as parsed by finding.parse_items
 
         Return Values:
         Item object. Returns None if could not get item's info.
         """
+        item = None
         try:
             item = Item(id=i['itemId'],
                         title=i['title'],
-                        price=i['sellingStatus']['convertedCurrentPrice']['value'],
+                        price=i['price'],
                         url=i['viewItemURL'],
                         location=i['location'],
-                        condition=i['condition']['conditionDisplayName'],
-                        start_time=i['listingInfo']['startTime'])
+                        condition=i['condition'],
+                        start_time=i['startTime'])
 
             item.thumbnail = i['galleryURL']
         except KeyError:
@@ -240,43 +248,518 @@ class Item:
         return item if item else None
 
     @staticmethod
-    def items_from_response(search, response):
-        """Runs through the items in the response and displays them"""
+    def items_from_response(queries, body, newest_start_times):
+        """Finds the items in the response not seen before by the queries and
+        displays them in the channels of every search subscribed to the
+        queries they belong to
+
+        Keyword Arguments:
+            queries            -- queries the request was made for
+            body               -- body of the findItemsAdvanced response
+            newest_start_times -- start time of the newest item every query
+                                  had seen before the request was made
+
+        Return Values:
+        Dictionary with the number of new items of every query.
+        Boolean representing whether older new items may be in the next page.
+        """
+        metadata = [extraction.get_metadata(q, newest_start_times[q])
+                    for q in queries]
+        return Item.items_from_extraction(queries,
+                                          extraction.extract(body, metadata))
+
+    @staticmethod
+    def items_from_extraction(queries, result):
+        """Displays the new items found by extraction.extract and moves
+        the queries' newest start time and seen items forward. The newest
+        start time also moves over the items that failed the checks, so
+        they aren't requested again. Only the items listed in the newest
+        second are kept as seen.
+
+        Return Values:
+        Dictionary with the number of new items of every query.
+        Boolean representing whether older new items may be in the next page.
+        """
+        items_data, ids, more, newest = result
+        new_items = dict.fromkeys(queries, 0)
+        items = {}
+        found = {}
+
+        for query, query_ids, looked_at in zip(queries, ids, newest):
+            newest_start_time = utils.iso_to_datetime(query.newest_start_time)
+            if looked_at:
+                newest_start_time = max(newest_start_time,
+                                        utils.iso_to_datetime(looked_at))
+            for item_id in query_ids:
+                item = items.get(item_id)
+                if item is None:
+                    item = items[item_id] = Item.item_from_data(items_data[item_id])
+                newest_start_time = max(newest_start_time, item.start_time)
+                new_items[query] += 1
+
+                searches = query.searches
+                if any(search.rules for search in searches):
+                    # The title is scanned once for the rules of every search
+                    if item_id not in found:
+                        found[item_id] = matcher.scan(item.title)
+                    searches = [search for search in searches
+                                if not search.rules
+                                or search.rules.accepts(found[item_id])]
+                item.display(search.channel_id for search in searches)
+
+            cursor = utils.datetime_to_iso(newest_start_time)
+            in_newest_second = [item_id for item_id in query_ids
+                                if items[item_id].start_time == newest_start_time]
+            if cursor != query.newest_start_time:
+                query.seen.move(in_newest_second)
+            else:
+                query.seen.add(in_newest_second)
+            if new_items[query] or cursor != query.newest_start_time:
+                changed_queries.add(query)
+            query.newest_start_time = cursor
+        return new_items, more
+
+
+class Query:
+    """Unique combination of ebay site, keywords and filters.
+
+    Searches added from different channels that look for the same items
+    share a single query so the ebay API is only called once per interval
+    and the new items are sent to every subscribed channel.
+    """
+    __slots__ = ('key', 'url', 'ebay_site', 'keywords', 'filters',
+                 'predicates', 'newest_start_time', 'searches', 'seen',
+                 'batch_term', 'title_pattern', 'batch', 'rate', 'polled_at')
+
+    def __init__(self, key, url, ebay_site, keywords, filters, predicates,
+                 newest_start_time=None):
+        self.key = key
+        self.url = url
+        self.ebay_site = ebay_site
+        self.keywords = keywords
+        self.filters = filters
+        self.predicates = predicates
+        self.newest_start_time = newest_start_time or utils.datetime_to_iso(
+            datetime.utcnow())
+        self.searches = []
+        self.seen = seen.SeenItems()
+        self.batch_term = Query.get_batch_term(key[1])
+        self.title_pattern = None  # Compiled once it is first matched
+        if self.batch_term:
+            self.title_pattern = \
+                r"\b" + re.escape(self.batch_term.strip('"')) + r"\b"
+        self.batch = None
+        self.rate = 0.0  # New items per second
+        self.polled_at = None
+
+    def get_cost(self):
+        """Returns the cost in API calls of the given query
+
+        Since queries with more than 25 countries in the LocatedIn filter
+        need to make multiple calls every time they are ran, they cost more
+        API calls than others.
+        """
         try:
-            data_r = ast.literal_eval(str(response.dict()))
-            newest_start_time = utils.iso_to_datetime(
-                search.newest_start_time)
-            aux_nst = newest_start_time
+            return math.ceil(len(self.filters.get("LocatedIn"))/25)
+        except TypeError:
+            return 1
 
-            for i in data_r['searchResult']['item']:
-                item = None
-                if Filters.filter_response_items(search, i):
-                    item = Item.item_from_data(i)
+    def get_batch_key(self):
+        """Returns the key shared by all queries that can be requested
+        together. Only the keywords can differ between them."""
+        return (self.key[0], self.key[2], self.key[3])
 
-                if not item:
-                    continue
+    def get_cursor_key(self):
+        """Returns the query's key as the string its cursor is saved with"""
+        return json.dumps(self.key, separators=(',', ':'), default=str)
 
-                if item.start_time_f > aux_nst:
-                    aux_nst = item.start_time_f
-                    aux_nst = aux_nst + timedelta(seconds=3)
-                elif item.start_time_f < newest_start_time:
-                    break
+    def get_cursor(self):
+        """Returns the newest start time and the items seen by the query.
 
-                item.display(search.channel)
+        Example: {'newest_start_time': '2020-08-01T10:00:00.000Z',
+                  'seen': ['174385026371', '174385026372']}
+        """
+        return {'newest_start_time': self.newest_start_time,
+                'seen': list(self.seen)}
 
-            search.newest_start_time = utils.datetime_to_iso(aux_nst)
-        except KeyError:
-            pass
+    def restore_cursor(self, cursor):
+        """Continues from a cursor saved before the bot was restarted"""
+        self.newest_start_time = cursor['newest_start_time']
+        self.seen.move(cursor['seen'])
+
+    def matches(self, title):
+        """Returns whether the item title matches the query's keywords"""
+        return bool(self.title_pattern and
+                    extraction.get_pattern(self.title_pattern).search(title))
+
+    @staticmethod
+    def get_batch_term(keywords):
+        """Returns the keywords as a term of eBay's OR syntax (a,b,c)
+        or None if the query can't be batched.
+
+        Only single words and single quoted phrases can be batched,
+        since those are the only keywords whose matches can be told
+        apart by looking at the item titles.
+        """
+        if re.fullmatch(r'\w+|"\w+(?: \w+)*"', keywords):
+            return keywords
+        return None
+
+    @staticmethod
+    def subscribe(search):
+        """Adds the search to the query matching its key, creating the query
+        if none exists.
+
+        Return Value:
+        Boolean representing whether a new query was created.
+        """
+        key = search.get_key()
+        query = query_list.get(key)
+        created = query is None
+        if created:
+            query = Query(key, search.url, search.ebay_site, search.keywords,
+                          search.filters, search.predicates)
+            query_list[key] = query
+            cursor = saved_cursors.pop(query.get_cursor_key(), None)
+            if cursor:
+                query.restore_cursor(cursor)
+            # Queries in partitions leased by other nodes are not fetched
+            if cluster.owns(query):
+                Batch.add_query(query)
+                if cursor:
+                    query.batch.catch_up = True
+        query.searches.append(search)
+        search.query = query
+        # Searches share the filters of their query instead of keeping a copy
+        search.filters = query.filters
+        return created
+
+    @staticmethod
+    def unsubscribe(search):
+        """Removes the search from its query and removes the query once no
+        searches are subscribed to it"""
+        query = search.query
+        if not query:
+            return
+        query.searches.remove(search)
+        search.query = None
+        if not query.searches:
+            del query_list[query.key]
+            if query.batch:
+                Batch.remove_query(query)
+            changed_queries.discard(query)
+            data.delete_cursors([query.get_cursor_key()])
+
+
+class Batch:
+    """Group of queries fetched with a single findItemsAdvanced request.
+
+    Queries in the same ebay site with the same filters are requested
+    together using eBay's OR keyword syntax. Example: (ambient,"drum machine")
+    Queries that can't be batched get a batch of their own.
+
+    Pages are sized from the rate the batch gets new items at, so quiet
+    batches get small responses. When every item of a small page was new,
+    the same items are requested again as a full page, the ones already
+    found being skipped as seen, so a burst never gets fewer items than a
+    full page would. The next full pages are followed when every item of
+    a full page was new.
+    After a restart, batches with queries restored from a saved cursor
+    catch up on the items listed while the bot was offline by following
+    the pages of their first request, as long as the catch up budget lasts.
+    Each of those pages is fetched as its own poll, so the workers keep
+    fetching the other batches in between.
+    """
+    __slots__ = ('queries', 'ebay_site', 'filters', 'queued', 'interval',
+                 'deadline', 'polled_at', 'catch_up', 'min_entries',
+                 'progress')
+
+    def __init__(self, queries):
+        self.queries = queries
+        self.ebay_site = queries[0].ebay_site
+        self.filters = queries[0].filters
+        self.queued = False
+        self.interval = None
+        self.deadline = None
+        self.polled_at = None
+        self.catch_up = False
+        self.min_entries = MIN_ENTRIES_PER_PAGE
+        self.progress = None  # State of a fetch waiting for its next page
+
+    @property
+    def keywords(self):
+        """Keywords of the request. Uses eBay's OR syntax when the batch
+        has more than one query"""
+        if len(self.queries) > 1:
+            return f"({','.join(q.batch_term for q in self.queries)})"
+        return self.queries[0].keywords
+
+    def fits(self, query):
+        """Returns whether the query can be added to the batch without
+        going over the batch_size setting or the keywords length limit"""
+        length = sum(len(q.batch_term) + 1 for q in self.queries) + 1
+        return (len(self.queries) < settings.get("batch_size")
+                and length + len(query.batch_term) + 1 <= MAX_KEYWORDS_LENGTH)
+
+    def is_full(self):
+        """Returns whether no more queries can be added to the batch"""
+        return len(self.queries) >= settings.get("batch_size")
+
+    def get_cost(self):
+        """Returns the cost in API calls of the batch. All queries in
+        the batch share the same filters and therefore the same cost."""
+        return self.queries[0].get_cost()
+
+    def get_search_ids(self, limit=20):
+        """Returns the IDs of the first searches subscribed to the batch's
+        queries"""
+        ids = [s.id for q in self.queries for s in q.searches[:limit]]
+        return ids[:limit]
+
+    def get_filters(self):
+        """Returns a copy of the batch's filters starting at the oldest
+        newest_start_time of its queries"""
+        filters = self.filters.copy()
+        filters['StartTimeFrom'] = min(
+            q.newest_start_time for q in self.queries)
+        return filters
+
+    def get_entries_per_page(self, seconds):
+        """Returns the size of the pages requested for the batch, with room
+        for a few times the items expected since the oldest newest start
+        time of its queries, the start of the request
+
+        Batches catching up and batches whose items are checked for
+        filters not sent in the request, where most items may fail the
+        checks, get full pages. The price bounds, seller, free shipping and
+        best offer filters are sent in the request too, so checking them
+        doesn't count. Pages are at least as large as the new items found
+        in the batch's last poll.
+
+        Keyword Arguments:
+            seconds            -- seconds since the start of the request
+        """
+        if self.catch_up or self.queries[0].predicates.is_selective():
+            return finding.ENTRIES_PER_PAGE
+        expected = scheduler.get_rate(self) * seconds * PAGE_SIZE_FACTOR
+        return min(max(math.ceil(expected), self.min_entries),
+                   finding.ENTRIES_PER_PAGE)
+
+    def can_follow(self, page):
+        """Returns whether the next page can be requested after a page
+        where every item was new
+
+        Batches catching up take the call from the catch up budget while
+        it lasts. Other polls follow up to MAX_FOLLOW_PAGES pages, as long
+        as the calls used following pages today are within FOLLOW_SHARE of
+        the daily calls.
+        """
+        global catch_up_calls
+        if usage.get_remaining() <= 0:
+            return False
+        if self.catch_up and page < MAX_CATCH_UP_PAGES and catch_up_calls > 0:
+            catch_up_calls -= 1
+            return True
+        if page >= MAX_FOLLOW_PAGES:
+            return False
+        day = usage.get_day()
+        if follow_calls["day"] != day:
+            follow_calls.update(day=day, calls=0)
+        if follow_calls["calls"] >= usage.settings["max_calls"] * FOLLOW_SHARE:
+            return False
+        follow_calls["calls"] += 1
+        return True
+
+    async def fetch_items(self):
+        """Formats the batch's filters to make findItemsAdvanced requests
+        and sources the new items from the responses. The number of new
+        items of every query is passed on to the scheduler.
+
+        Queries can join or leave the batch while a request is in flight,
+        so the whole fetch works on the queries the batch had when it
+        started.
+        When catching up, the batch is given back to the scheduler after
+        every page and the fetch continues from where it was left when the
+        batch is polled again. So does a fetch stopped by the site being
+        paused, once the site can be called again."""
+        if self.progress:
+            (queries, keywords, filters, temp_filters, page,
+             newest_start_times, seen_ids, new_items, entries_per_page,
+             pages) = self.progress
+            self.progress = None
+        else:
+            queries = list(self.queries)
+            keywords = self.keywords
+            filters, temp_filters = None, self.get_filters()
+            page = None
+            newest_start_times = {q: utils.iso_to_datetime(q.newest_start_time)
+                                  for q in queries}
+            # Pages can overlap and the queries only keep the items of
+            # their newest second, so the items found by the whole fetch
+            # are told apart here
+            seen_ids = {q: set(q.seen.ids) for q in queries}
+            new_items = dict.fromkeys(queries, 0)
+            entries_per_page = self.get_entries_per_page(
+                (datetime.utcnow() - min(newest_start_times.values())).total_seconds())
+            pages = 0
+
+        while page or temp_filters:
+            if not page:
+                filters, temp_filters = temp_filters.get_for_request()
+                page = 1
+            if not circuit.allow(self.ebay_site):
+                # The fetch waits for the site to recover and continues
+                # from this page instead of skipping the poll
+                self.progress = (queries, keywords, filters, temp_filters,
+                                 page, newest_start_times, seen_ids,
+                                 new_items, entries_per_page, pages)
+                paused_until = circuit.get_paused_until(self.ebay_site)
+                scheduler.defer(self, circuit.BASE_DELAY if paused_until is None
+                                else paused_until - time.monotonic())
+                return
+            try:
+                api_request = {'keywords': f'{keywords}',
+                               'itemFilter': filters,
+                               'sortOrder': 'StartTimeNewest'}
+                if queries[0].predicates.needs_seller():
+                    api_request['outputSelector'] = 'SellerInfo'
+                api_request['paginationInput'] = {
+                    'entriesPerPage': entries_per_page, 'pageNumber': page}
+
+                start = time.perf_counter()
+                try:
+                    with tracing.span("finding", site=self.ebay_site,
+                                      page=page):
+                        body = await finding.execute('findItemsAdvanced',
+                                                     api_request, self.ebay_site)
+                finally:
+                    if metrics.enabled:
+                        metrics.observe_call(self.ebay_site,
+                                             time.perf_counter() - start)
+                circuit.record_success(self.ebay_site)
+
+                with tracing.span("extract", site=self.ebay_site,
+                                  bytes=len(body)):
+                    metadata = [extraction.get_metadata(
+                        q, newest_start_times[q], seen_ids[q]) for q in queries]
+                    result = await extraction.extract_async(
+                        body, metadata, entries_per_page)
+                with tracing.span("display", site=self.ebay_site,
+                                  items=len(result[0])):
+                    counts, more = Item.items_from_extraction(queries,
+                                                              result)
+                for query, count in counts.items():
+                    new_items[query] += count
+                for query, query_ids in zip(queries, result[1]):
+                    seen_ids[query].update(map(seen.SeenItems.to_key, query_ids))
+            except asyncio.TimeoutError:
+                circuit.record_failure(self.ebay_site)
+                if metrics.enabled:
+                    metrics.count_error("timeout")
+                more = False
+            except aiohttp.ClientError as e:
+                circuit.record_failure(self.ebay_site)
+                if metrics.enabled:
+                    metrics.count_error(type(e).__name__)
+                more = False
+            except finding.FindingError as e:
+                print(f"Exception in get_items: {e}")
+                # Errors of the request itself say nothing about the site
+                if circuit.is_site_failure(e):
+                    circuit.record_failure(self.ebay_site,
+                                           circuit.is_rate_limited(e))
+                else:
+                    circuit.record_success(self.ebay_site)
+                if metrics.enabled:
+                    metrics.count_error(
+                        f"finding_{e.error_ids[0] if e.error_ids else e.status}")
+                more = False
+
+            pages = max(pages, page)
+            if more and entries_per_page < finding.ENTRIES_PER_PAGE \
+               and usage.get_remaining() > 0:
+                entries_per_page = finding.ENTRIES_PER_PAGE
+                page = 1
+            else:
+                page = page + 1 if more and self.can_follow(page) else None
+            if page and self.catch_up:
+                # The next page waits in the scheduler instead of
+                # holding the worker
+                self.progress = (queries, keywords, filters, temp_filters,
+                                 page, newest_start_times, seen_ids,
+                                 new_items, entries_per_page, pages)
+                scheduler.defer(self, CATCH_UP_DELAY)
+                return
+
+        self.min_entries = min(max(sum(new_items.values()), MIN_ENTRIES_PER_PAGE),
+                               finding.ENTRIES_PER_PAGE)
+        self.catch_up = False
+        for query, count in new_items.items():
+            scheduler.observe(query, count)
+
+    @staticmethod
+    def add_query(query):
+        """Adds the query to the first compatible batch with room left,
+        or to a new batch, and updates the total search cost.
+
+        Compatible batches are the ones in the same ebay site with the same
+        filters, so only the batches in the query's group are looked at.
+        Full batches leave the group, so adding many queries stays linear.
+        """
+        global total_search_cost
+        group = None
+        if settings.get("batch_size") > 1 and query.batch_term:
+            group = batch_groups.setdefault(query.get_batch_key(), [])
+            for batch in group:
+                if batch.fits(query):
+                    batch.queries.append(query)
+                    query.batch = batch
+                    if batch.is_full():
+                        group.remove(batch)
+                    return
+
+        batch = Batch([query])
+        query.batch = batch
+        batch_list[batch] = None
+        if group is not None:
+            group.append(batch)
+        total_search_cost += batch.get_cost()
+        scheduler.add(batch)
+
+    @staticmethod
+    def remove_query(query):
+        """Removes the query from its batch, removing the batch once it is
+        empty, and updates the total search cost"""
+        global total_search_cost
+        batch = query.batch
+        batch.queries.remove(query)
+        query.batch = None
+        group = batch_groups.get(query.get_batch_key())
+        if batch.queries:
+            if group is not None and batch not in group:
+                group.append(batch)  # The batch has room again
+            return
+
+        del batch_list[batch]
+        total_search_cost -= query.get_cost()
+        if group and batch in group:
+            group.remove(batch)
+            if not group:
+                del batch_groups[query.get_batch_key()]
 
 
 class Search:
-    def __init__(self, url, channel,
-                 newest_start_time=utils.datetime_to_iso(datetime.utcnow())):
+    __slots__ = ('id', 'url', 'ebay_site', 'keywords', 'filters',
+                 'predicates', 'channel_id', 'query', 'rules')
+
+    def __init__(self, url, channel_id, id=None):
+        self.id = id
         self.url = url
-        self.ebay_site, self.keywords, self.filters = Search.get_search_from_url(
-            url)
-        self.channel = channel
-        self.newest_start_time = newest_start_time
+        self.ebay_site, self.keywords, self.filters, self.predicates = \
+            Search.get_search_from_url(url)
+        self.channel_id = channel_id
+        self.query = None
+        self.rules = None
 
     async def add_to_list(self):
         """Adds the search to the list of searches and updates the interval
@@ -289,27 +772,77 @@ class Search:
         if not self.url or not self.ebay_site or not self.keywords:
             return False, "The provided URL seems to be invalid.\nGo to ebay, make a search by keywords, and copy the URL in your browser's address bar."
 
-        search_list.append(self)
-
-        global total_search_cost
-        total_search_cost += self.get_cost()
+        self.add_to_index()
+        Query.subscribe(self)
 
         if not bot.update_get_items_interval():
-            total_search_cost -= self.get_cost()
-            search_list.remove(self)
+            Query.unsubscribe(self)
+            self.remove_from_index()
             return False, "The maximum number of searches has been reached."
 
         return True, ""
 
-    def set_newest_start_time_filter(self):
-        """Adds the StartTimeFrom filter to the search's filters using the 
-        updated newest_start_time attribute"""
-        self.filters['StartTimeFrom'] = self.newest_start_time
+    def add_to_index(self):
+        """Adds the search to the list of searches and to its channel's"""
+        search_list[self] = None
+        channel_searches.setdefault(self.channel_id, {})[self] = None
+
+    def remove_from_index(self):
+        """Removes the search from the list of searches and from its
+        channel's"""
+        search_list.pop(self, None)
+        searches = channel_searches.get(self.channel_id)
+        if searches is not None:
+            searches.pop(self, None)
+            if not searches:
+                del channel_searches[self.channel_id]
+
+    def get_key(self):
+        """Returns the canonical key of the search. Searches with the same key
+        always get the same items from the API.
+
+        Example: ('EBAY-US', 'selected ambient works cd',
+                  (('MaxPrice', '20'),), (('MaxPrice', Decimal('20')),))
+        """
+        filters = []
+        for name in sorted(self.filters):
+            value = self.filters[name]
+            if isinstance(value, list):
+                value = tuple(sorted(value))
+            filters.append((name, value))
+
+        keywords = sys.intern(" ".join(self.keywords.lower().split()))
+        return (self.ebay_site, keywords, tuple(filters), self.predicates.spec)
+
+    def get_interval_str(self):
+        """Returns the interval the search is currently fetched at as a
+        formatted string to display. Example: ' · every 2m 30s'"""
+        batch = self.query.batch if self.query else None
+        if not batch or not batch.interval:
+            return ""
+        minutes, seconds = divmod(math.ceil(batch.interval), 60)
+        return f" · every {minutes}m {seconds}s" if minutes else f" · every {seconds}s"
+
+    def update_rules(self, include=(), exclude=(), replace=False):
+        """Adds terms to the title rules of the search, or replaces them,
+        and updates the terms in the shared automaton
 
-    def get_filters(self):
-        """Returns a copy of the search's filters"""
-        self.set_newest_start_time_filter()
-        return self.filters.copy()
+        Keyword Arguments:
+            include            -- terms the item titles must contain
+            exclude            -- terms the item titles must not contain
+            replace            -- whether to replace the current terms
+                                  instead of adding to them
+        """
+        old = self.rules
+        if old and not replace:
+            include = [*old.include, *include]
+            exclude = [*old.exclude, *exclude]
+        rules = matcher.Rules(include, exclude) or None
+        if rules:
+            matcher.add_rules(rules)
+        if old:
+            matcher.remove_rules(old)
+        self.rules = rules
 
     async def get_display_embed(self, message):
         """Returns a Discord embed displaying the search"""
@@ -320,19 +853,47 @@ class Search:
                         value=f"`{self.ebay_site}`", inline=True)
         embed.add_field(
             name="Filters", value=f"[See on ebay]({self.url})", inline=True)
+        if self.rules:
+            include = ", ".join(f"`{t}`" for t in sorted(self.rules.include))
+            exclude = ", ".join(f"`{t}`" for t in sorted(self.rules.exclude))
+            embed.add_field(name="Must contain",
+                            value=include[:MAX_CHARACTERS] or "\u200b", inline=True)
+            embed.add_field(name="Must not contain",
+                            value=exclude[:MAX_CHARACTERS] or "\u200b", inline=True)
         return embed
 
-    def get_cost(self):
-        """Returns the cost in API calls of the given search
+    @staticmethod
+    async def edit_rules(index, channel, include=(), exclude=(), clear=False):
+        """Changes the title rules of the search in the given index of the
+        channel's list and saves them
 
-        Since searches with more than 25 countries in the LocatedIn filter
-        need to make multiple calls every time they are ran, they cost more
-        API calls than others.
+        Keyword Arguments:
+            index             -- index of the search in the channel's list
+            channel           -- Discord channel object of the requesting channel
+            include           -- terms to add to the ones the titles must contain
+            exclude           -- terms to add to the ones the titles must not contain
+            clear             -- whether to remove every rule of the search
+
+        Return Values:
+        Discord embed displaying the search and its rules. Returns None if
+        there is no search in the given index.
+        Error message if any
         """
-        try:
-            return math.ceil(len(self.filters.get("LocatedIn"))/25)
-        except TypeError:
-            return 1
+        searches = get_channel_searches(channel.id)
+        if not index.isdigit() or not 0 < int(index) <= len(searches):
+            return None, f"There is no search #{index} in this channel."
+        search = searches[int(index) - 1]
+        if clear:
+            search.update_rules(replace=True)
+        elif include or exclude:
+            search.update_rules(include, exclude)
+        else:
+            return await search.get_display_embed(f"Search #{index}"), ""
+
+        rules = search.rules
+        data.set_rules(search.id, sorted(rules.include) if rules else [],
+                       sorted(rules.exclude) if rules else [])
+        return await search.get_display_embed(f"Updated rules of search #{index}"), ""
 
     @staticmethod
     async def delete(indexes, channel):
@@ -346,35 +907,21 @@ class Search:
         Return Values:
         Discord embed displaying a list of the removed searches
         """
-        global total_search_cost
-        search_list = get_search_list()
-        removed_searches = []
-        indexes = [int(i) for i in indexes]
-        indexes = sorted(indexes)
-        o_indexes = indexes.copy()
-        index = 1
-        channels_searches = [s for s in search_list if s.channel.id == channel.id]
-        for search in channels_searches:
-            if index in indexes:
-                try:
-                    removed = search
-                    removed_searches.append(removed)
-                    search_list.remove(search)
-                    total_search_cost -= removed.get_cost()
-                    indexes.remove(index)
-                    if not indexes:
-                        break
-                except IndexError:
-                    o_indexes.remove(index)
-            index += 1
+        searches = get_channel_searches(channel.id)
+        indexes = sorted({int(i) for i in indexes
+                          if i.isdigit() and 0 < int(i) <= len(searches)})
+        removed_searches = [searches[i - 1] for i in indexes]
+        for search in removed_searches:
+            search.remove_from_index()
+            Query.unsubscribe(search)
+            search.update_rules(replace=True)
         bot.update_get_items_interval()
         await bot.update_presence()
-        removed_searches.reverse()
         result = await Search.get_list_display_embed(list=removed_searches,
                                                      title="Removed searches",
                                                      color=0xed474a,
-                                                     indexes=o_indexes)
-        await Search.save_searches()
+                                                     indexes=indexes)
+        data.delete_searches([s.id for s in removed_searches])
         return result
 
     @staticmethod
@@ -391,11 +938,11 @@ class Search:
         could not be added.
         Error message if any
         """
-        search = Search(url, channel)
+        search = Search(url, channel.id)
         result, message = await search.add_to_list()
         if not result:
             return None, message
-        await Search.save_searches()
+        search.id = data.add_search(url, channel.id)
         await bot.update_presence()
         return await search.get_display_embed("Added search:"), ""
 
@@ -409,8 +956,8 @@ class Search:
             url               -- URL of the ebay search given by the user
 
         Return Values:
-        Ebay site Global ID, search keywords and search filters as
-        a Filter object
+        Ebay site Global ID, search keywords, search filters as
+        a Filter object and the checks run on the items as a Predicates object
         """
         parsed = urlparse.urlparse(url)
         query = urlparse.parse_qs(parsed.query)
@@ -420,10 +967,14 @@ class Search:
         ebay_site = mapping.map_ebay_site_to_id(ebay_site)
 
         keywords = query.get('_nkw')[0] if query.get('_nkw') else None
+        if keywords:
+            # Many searches share the same keywords
+            keywords = sys.intern(keywords)
 
         filters = Filters.get_from_query(query, ebay_site)
+        predicates = extraction.get_predicates(query)
 
-        return ebay_site, keywords, filters
+        return ebay_site, keywords, filters, predicates
 
     @staticmethod
     async def get_searches_table(list, page, indexes):
@@ -454,7 +1005,7 @@ class Search:
                 break
             number = i+1 if not indexes else int(next(indexes))
             fields.append(
-                {'#': f'{number}', 'Keywords': f'**[{list[i].keywords}]({list[i].url})**', 'Ebay site': f'{list[i].ebay_site.lower()}'})
+                {'#': f'{number}', 'Keywords': f'**[{list[i].keywords}]({list[i].url})**', 'Ebay site': f'{list[i].ebay_site.lower()}{list[i].get_interval_str()}'})
 
         if not fields and (page == 1 and not indexes):
             fields = None
@@ -465,7 +1016,7 @@ class Search:
         return fields, math.ceil(len(list)/MAX_SEARCHES)
 
     @staticmethod
-    async def get_list_display_embed(channel=None, list=search_list, page=1, title="Searches", color=0x1098f7, indexes=None):
+    async def get_list_display_embed(channel=None, list=None, page=1, title="Searches", color=0x1098f7, indexes=None):
         """Returns the list of searches for the specified page as a valid and formatted
         Discord embed. Custom list of searches and indexes for the searches as well as custom color 
         and title for the embed can be provided.
@@ -482,7 +1033,9 @@ class Search:
         Discord embed.
         """
         if channel:
-            list = [s for s in search_list if s.channel.id == channel.id]
+            list = get_channel_searches(channel.id)
+        elif list is None:
+            list = [*search_list]
 
         fields, total_pages = await Search.get_searches_table(list, page, indexes)
 
@@ -502,104 +1055,162 @@ class Search:
 
         embed.set_footer(text=f"\u200b\n< {page} / {total_pages} >"
                               "\n\n"
-                              f"Fetching items every {bot.get_items_interval_str()}")
+                              f"Fetching items every {bot.get_items_interval_str()} on average")
         return embed
 
-    @staticmethod
-    async def save_searches():
-        """Saves list of searches as JSON object"""
-        data_s = {}
-        data_s['searches'] = []
-        for search in search_list:
-            data_s["searches"].append(
-                {'url': search.url,
-                 'channel_id': f"{search.channel.id}"})
-            await asyncio.sleep(0.01)
-        data.save(data_s)
-
     @staticmethod
     async def read_searches():
-        """Gets list of searches from saved JSON object and starts Getter threads
-
-        Getter threads are responsible for getting items from searches put
-        into the queue by the get_items task."""
-        try:
-            json_s = data.read()
-            data_s = json.loads(json_s)
-            for q in data_s['searches']:
-                channel = bot.get_bot().get_channel(int(q['channel_id']))
-                if not channel:
-                    continue
-                search = Search(q['url'], channel)
-                await search.add_to_list()
-        except KeyError:
-            pass
+        """Gets list of searches from the storage and starts the
+        fetch workers
+
+        Fetch workers are responsible for getting items from searches put
+        into the queue by the scheduler.
+        The queries continue from the cursors saved before the restart and
+        part of the remaining calls is set aside to catch up on the items
+        listed while the bot was offline."""
+        global catch_up_calls
+        cluster.start()
+        await metrics.start()
+        saved_cursors.update(data.load_cursors())
+        catch_up_calls = int(usage.get_remaining() * CATCH_UP_SHARE)
+        records = data.load_searches()
+        # Only the gateway can tell whether the channel still exists
+        if cluster.is_gateway():
+            channels = bot.get_existing_channels(
+                {r['channel_id'] for r in records})
+            records = [r for r in records if r['channel_id'] in channels]
+        Search.add_many(records)
+        saved_cursors.clear()
+        if cluster.is_gateway():
+            data.export()  # In case the last export was lost
         await bot.update_presence()
+        Search.start_workers()
         bot.start_get_items()
 
-        for i in range(MAX_THREADS):
-            get_items_thread = threading.Thread(
-                target=Search.get_items, name=f"Getter{i}", daemon=True)
-            threads.append(get_items_thread)
-            get_items_thread.start()
+    @staticmethod
+    def add_many(records):
+        """Adds the searches of the given storage records to the list of
+        searches, updating the interval of the get_items task only once.
+        Used to load the stored searches in bulk.
+
+        Return Value:
+        List of the searches added.
+        """
+        added = []
+        for record in records:
+            search = Search(record['url'], record['channel_id'], record['id'])
+            if not search.url or not search.ebay_site or not search.keywords:
+                continue
+            search.add_to_index()
+            Query.subscribe(search)
+            if record.get('include') or record.get('exclude'):
+                search.update_rules(record.get('include') or (),
+                                    record.get('exclude') or ())
+            added.append(search)
+
+        # Like add_to_list, the newest searches over the limit are left out.
+        # Only the searches this node fetches count towards its limit, and
+        # the gateway is told about the ones left out by the other nodes.
+        for search in reversed(added.copy()):
+            if bot.update_get_items_interval():
+                break
+            if not cluster.owns(search.query):
+                continue
+            added.remove(search)
+            Query.unsubscribe(search)
+            search.remove_from_index()
+            search.update_rules(replace=True)
+            if not cluster.is_gateway():
+                cluster.reject(search)
+        return added
+
+    @staticmethod
+    async def remove_rejected(ids):
+        """Removes the searches that the nodes fetching them had no room
+        for and tells their channels
+
+        Keyword Arguments:
+            ids               -- IDs of the rejected searches
+        """
+        removed = {}
+        for search in list(search_list):
+            if search.id in ids:
+                removed.setdefault(search.channel_id, []).append(search)
+        for channel_id, searches in removed.items():
+            channel_searches = get_channel_searches(channel_id)
+            embed = await Search.get_list_display_embed(
+                list=searches, color=0xed474a,
+                title="Removed searches: the maximum number of searches has been reached",
+                indexes=[channel_searches.index(s) + 1 for s in searches])
+            for search in searches:
+                search.remove_from_index()
+                Query.unsubscribe(search)
+                search.update_rules(replace=True)
+            dispatcher.send(channel_id, embed)
+        bot.update_get_items_interval()
+        await bot.update_presence()
+        data.delete_searches(list(ids))
 
     @staticmethod
-    def get_items():
-        """Task ran by Getter threads to get new items listed from the searches
-        in the queue
+    def start_workers():
+        """Creates the work queue and starts as many fetch workers as
+        the concurrency setting allows. Must be called from the event loop."""
+        global queue
+        queue = asyncio.Queue()
+        for _ in range(settings.get("concurrency")):
+            workers.append(asyncio.ensure_future(Search.get_items()))
 
-        Gets next search from the queue and formats it's filters to then create 
-        a findItemsAdvanced request object. New items are then sourced from the
-        reponse."""
+    @staticmethod
+    async def get_items():
+        """Task ran by fetch workers to get new items listed from the batches
+        of queries in the queue
 
+        Waits for the next batch in the queue and fetches it. Waiting on the
+        queue does not use any CPU while there is nothing to fetch."""
         while True:
+            batch = await queue.get()
             try:
-                self = queue.pop(0)
-
-                temp_filters = self.get_filters()
-
-                while temp_filters:
-                    try:
-                        filters, temp_filters = temp_filters.get_for_request()
-
-                        api = Finding(domain=settings.get("domain"),
-                                      appid=settings.get("appid"),
-                                      version=settings.get("version"),
-                                      config_file=None,
-                                      site_id=self.ebay_site)
-
-                        api_request = {'keywords': f'{self.keywords}',
-                                       'itemFilter': filters,
-                                       'sortOrder': 'StartTimeNewest'}
-
-                        response = api.execute(
-                            'findItemsAdvanced', api_request)
-
-                        # # FIXME: Uncomment for debug only
-                        # print(f"{response.headers}  :  {response.content}")
-
-                        Item.items_from_response(self, response)
-                    except ConnectionError:
-                        pass
-                    except AttributeError as e:
-                        print(f"Exception in get_items: {e}")
-                        pass
-                    except Exception as e:  # idc just stop breaking
-                        print(f"Exception in get_items: {e}")
-                        pass
-
-            except IndexError:
-                time.sleep(0.01)
-                continue
+                # The search IDs are only gathered while tracing
+                span = tracing.NULL_SPAN if not tracing.enabled else \
+                    tracing.span("batch", site=batch.ebay_site,
+                                 searches=batch.get_search_ids())
+                with span:
+                    await batch.fetch_items()
+            except Exception as e:  # idc just stop breaking
+                print(f"Exception in get_items: {e}")
+                if metrics.enabled:
+                    metrics.count_error(type(e).__name__)
+            finally:
+                batch.queued = False
+                queue.task_done()
+            if time.monotonic() - cursors_saved_at > CURSORS_SAVE_INTERVAL:
+                Search.save_cursors()
+
+    @staticmethod
+    def save_cursors():
+        """Saves the cursors of the queries that got new items since they
+        were last saved"""
+        global cursors_saved_at
+        cursors_saved_at = time.monotonic()
+        cursors = {q.get_cursor_key(): q.get_cursor() for q in changed_queries}
+        changed_queries.clear()
+        try:
+            data.save_cursors(cursors)
+        except Exception as e:
+            print(f"Unable to save cursors\nException: {e}")
 
     @staticmethod
-    async def get_items_list():
-        for search in search_list:
-            if len(queue) < len(search_list):
-                queue.append(search)
+    def enqueue(batch):
+        """Puts the batch into the queue unless it is already waiting
+        to be fetched"""
+        if not batch.queued:
+            batch.queued = True
+            queue.put_nowait(batch)
 
 
 def get_total_search_cost():
+    """Returns the cost in API calls of fetching every batch of
+    unique queries once"""
     return total_search_cost
 
 
@@ -613,18 +1224,47 @@ def get_search_list():
     return search_list
 
 
+def get_channel_searches(channel_id):
+    """Returns the list of searches added in the channel"""
+    return [*channel_searches.get(channel_id, ())]
+
+
 def read_settings():
     """Reads settings from settings.yaml file and initializes the
     settings dictionary."""
     with open(utils.get_file_path("../settings.yaml")) as file:
         _settings = yaml.safe_load(file)
 
+        data.read_settings(_settings)
         global settings
         settings["max_calls"] = _settings["ebay"]["max_daily_calls"]
-        settings["domain"] = _settings["ebay"]["domain"]
-        settings["appid"] = _settings["ebay"]["appid"]
-        settings["version"] = _settings["ebay"]["version"]
+        usage.settings["max_calls"] = settings["max_calls"]
+        settings["concurrency"] = _settings["ebay"].get("concurrency", 20)
+        settings["batch_size"] = _settings["ebay"].get("batch_size", 10)
+        extraction.settings["processes"] = _settings["ebay"].get("parse_processes", 0)
+        cluster.read_settings(_settings.get("cluster"))
+        metrics.settings.update(_settings.get("metrics") or {})
+        tracing.settings.update(_settings.get("tracing") or {})
+        if tracing.settings["enabled"]:
+            tracing.start(tracing.settings["size"])
+        finding.settings["domain"] = _settings["ebay"]["domain"]
+        finding.settings["appid"] = _settings["ebay"]["appid"]
+        finding.settings["version"] = _settings["ebay"]["version"]
+        for key in ("timeout", "connect_timeout", "pool_size", "keepalive"):
+            if key in _settings["ebay"]:
+                finding.settings[key] = _settings["ebay"][key]
 
 
 def main():
     read_settings()
+    usage.load()
+
+
+def shutdown():
+    """Saves everything that is waiting to be saved before the bot exits"""
+    Search.save_cursors()
+    cluster.stop()
+    extraction.shutdown()
+    usage.save()
+    data.export()
+    data.flush()
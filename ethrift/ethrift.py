@@ -1,10 +1,17 @@
 import ebay
 import bot
+import cluster
 
 
 def main():
     ebay.main()
-    bot.main()
+    try:
+        if cluster.is_gateway():
+            bot.main()
+        else:
+            cluster.main()
+    finally:
+        ebay.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,267 @@
+"""Parsing of the responses and detection of the new items.
+
+Extraction only takes the response body and compact metadata of the
+queries, so it can run either in the event loop or in a pool of worker
+processes, where parsing doesn't hold the GIL of the bot's process.
+Only the new items of every query are sent back.
+"""
+import asyncio
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+import utils
+import finding
+import seen
+
+
+# Fields an item needs to be displayed
+REQUIRED_FIELDS = ('itemId', 'title', 'price', 'viewItemURL', 'location',
+                   'condition', 'startTime')
+# Checks whose filters are also sent in the request, so they only catch
+# the few items the API lets through
+REQUEST_CHECKS = ('BestOffer', 'FreeShipping', 'Seller', 'MinPrice', 'MaxPrice')
+
+settings = {"processes": 0}
+
+pool = None
+predicates_list = {}
+patterns = {}
+
+
+class Predicates:
+    """Chain of checks run on the items of the responses for the filters
+    that the API doesn't apply exactly, like items accepting best offers,
+    free shipping, a specific seller or the exact price bounds. They are
+    sent in the request too and the checks only catch what the API lets
+    through.
+
+    The checks are compiled once from the search URL and shared by every
+    search and query with the same filters.
+    """
+    __slots__ = ('spec', 'checks')
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.checks = tuple(Predicates.compile(name, value)
+                            for name, value in spec)
+
+    def __call__(self, item):
+        """Returns whether the item, as parsed by finding.parse_items,
+        passes every check"""
+        for check in self.checks:
+            if not check(item):
+                return False
+        return True
+
+    def is_selective(self):
+        """Returns whether the checks may reject most items of a response,
+        because some of their filters are not sent in the request"""
+        return any(name not in REQUEST_CHECKS for name, _ in self.spec)
+
+    def needs_seller(self):
+        """Returns whether the responses need the seller info for the checks"""
+        return any(name == 'Seller' for name, _ in self.spec)
+
+    @staticmethod
+    def get_price(item, field):
+        """Returns the price in the given field of the item as a Decimal,
+        or None if it has no valid price"""
+        try:
+            return Decimal(item[field])
+        except (KeyError, TypeError, InvalidOperation):
+            return None
+
+    @staticmethod
+    def compile(name, value):
+        """Returns the function checking the item for the given filter"""
+        if name == 'BestOffer':
+            return lambda i: i.get('bestOfferEnabled') != "false"
+        if name == 'FreeShipping':
+            return lambda i: (i.get('shippingType') == "Free"
+                              or Predicates.get_price(i, 'shippingCost') == 0)
+        if name == 'Seller':
+            return lambda i: (i.get('seller') or '').lower() == value
+        if name == 'MinPrice':
+            def check(i):
+                price = Predicates.get_price(i, 'price')
+                return price is not None and price >= value
+            return check
+        if name == 'MaxPrice':
+            def check(i):
+                price = Predicates.get_price(i, 'price')
+                return price is not None and price <= value
+            return check
+        raise ValueError(f"Unknown predicate {name}")
+
+    @staticmethod
+    def get_spec_from_query(query):
+        """Gets the filters checked on the items from the ebay search url
+        query string, cheapest checks first
+
+        Return Value:
+        Tuple of the filter names and values.
+        Example: (('BestOffer', True), ('MaxPrice', Decimal('20')))
+        """
+        spec = []
+        if query.get('LH_BO'):
+            spec.append(('BestOffer', True))
+        if query.get('LH_FS'):
+            spec.append(('FreeShipping', True))
+        if query.get('_ssn'):
+            spec.append(('Seller', query.get('_ssn')[0].strip().lower()))
+        for name, param in (('MinPrice', '_udlo'), ('MaxPrice', '_udhi')):
+            try:
+                spec.append((name, Decimal(query.get(param)[0])))
+            except (TypeError, InvalidOperation):
+                pass
+        return tuple(spec)
+
+
+def get_predicates(query):
+    """Returns the compiled checks for the ebay search url query string.
+    Searches with the same filters get the same Predicates object."""
+    return get_compiled(Predicates.get_spec_from_query(query))
+
+
+def get_compiled(spec):
+    """Returns the Predicates object of the given spec, compiling it
+    the first time"""
+    predicates = predicates_list.get(spec)
+    if predicates is None:
+        predicates = predicates_list[spec] = Predicates(spec)
+    return predicates
+
+
+def get_pattern(pattern):
+    """Returns the compiled title pattern"""
+    compiled = patterns.get(pattern)
+    if compiled is None:
+        compiled = patterns[pattern] = re.compile(pattern, re.IGNORECASE)
+    return compiled
+
+
+def get_metadata(query, newest_start_time, seen_ids=None):
+    """Returns what extract needs to know about the query
+
+    Keyword Arguments:
+        query              -- query the request was made for
+        newest_start_time  -- start time of the newest item the query had
+                              seen before the request was made
+        seen_ids           -- keys of the items seen by the query, if not
+                              only the ones in its seen items
+
+    Return Value:
+    Tuple of the query's title pattern, newest start time as an ISO string,
+    seen item IDs and predicates spec.
+    """
+    pattern = query.title_pattern
+    return (pattern, utils.datetime_to_iso(newest_start_time),
+            tuple(query.seen.ids if seen_ids is None else seen_ids),
+            query.predicates.spec)
+
+
+def extract(body, metadata, entries_per_page=finding.ENTRIES_PER_PAGE):
+    """Runs through the items in the response and finds the items of
+    every query that it hasn't seen before
+
+    When the request was made for a batch of queries, the items are
+    routed back to their queries by matching their titles.
+    Since requests start at the newest start time seen, the items
+    listed in that same second are returned again and are told apart
+    by the queries' seen items.
+    The body is parsed lazily and parsing stops once every query has
+    reached items older than its newest start time.
+    The next page is only worth requesting when the page is full and its
+    last item is newer than the newest start time and wasn't seen before.
+    Failing the checks says nothing about the older items, so the items
+    that fail them don't stop the pages from being followed.
+
+    Keyword Arguments:
+        body               -- body of the findItemsAdvanced response
+        metadata           -- get_metadata of every query in the request
+        entries_per_page   -- page size of the request
+
+    Return Values:
+    Dictionary with the fields of the new items by item ID.
+    List with the IDs of the new items that passed every check for every
+    query, in the order they were found.
+    Boolean representing whether older new items may be in the next page.
+    List with the start time of the newest item looked at for every query,
+    including the ones that failed the checks, or None.
+    """
+    batched = len(metadata) > 1
+    # Queries are only batched together when they have the same filters
+    predicates = get_compiled(metadata[0][3])
+    queries = []
+    for pattern, newest_start_time, seen_items, _ in metadata:
+        queries.append((get_pattern(pattern) if batched and pattern else None,
+                        utils.iso_to_datetime(newest_start_time),
+                        set(seen_items)))
+    ids = [[] for _ in metadata]
+    newest = [None for _ in metadata]
+    pending = list(range(len(metadata)))
+    new_items = {}
+    entries = 0
+    stale = False  # Whether the last item was old or seen before
+
+    for i in finding.parse_items(body):
+        start_time = None
+        accepted = None
+        entries += 1
+        stale = False
+
+        for n in pending.copy():
+            pattern, newest_start_time, seen_items = queries[n]
+            if batched and not (pattern and pattern.search(i.get('title', ''))):
+                continue
+
+            if start_time is None:
+                if any(field not in i for field in REQUIRED_FIELDS):
+                    break
+                start_time = utils.iso_to_datetime(i['startTime'])
+
+            if start_time < newest_start_time:
+                pending.remove(n)
+                stale = True
+                continue
+            if newest[n] is None:
+                # Items come newest first
+                newest[n] = i['startTime']
+            if accepted is None:
+                accepted = predicates(i)
+            if not accepted:
+                continue
+            if seen.SeenItems.to_key(i['itemId']) not in seen_items:
+                new_items[i['itemId']] = i
+                ids[n].append(i['itemId'])
+            else:
+                stale = True
+
+        if not pending:
+            break
+
+    more = bool(pending) and entries >= entries_per_page and not stale
+    return new_items, ids, more, newest
+
+
+async def extract_async(body, metadata,
+                        entries_per_page=finding.ENTRIES_PER_PAGE):
+    """Runs extract in the pool of worker processes, when enabled, or
+    right away otherwise"""
+    if not settings.get("processes"):
+        return extract(body, metadata, entries_per_page)
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(settings.get("processes"))
+    return await asyncio.get_event_loop().run_in_executor(
+        pool, extract, body, metadata, entries_per_page)
+
+
+def shutdown():
+    """Stops the worker processes"""
+    global pool
+    if pool is not None:
+        pool.shutdown()
+        pool = None
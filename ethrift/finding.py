@@ -0,0 +1,288 @@
+"""Asynchronous client for the eBay Finding API.
+
+Requests are sent with aiohttp so they can run on the bot's event loop
+instead of blocking a thread per request like ebaysdk does.
+Every ebay site (Global ID) gets its own pool of keep-alive connections
+that is shared by all the searches in that site. Requests wait for a free
+connection in the order they were made, before their timeout starts.
+"""
+import aiohttp
+import asyncio
+import time
+import statistics
+import xml.etree.ElementTree as ElementTree
+
+from collections import deque
+from xml.sax.saxutils import escape
+
+import usage
+
+
+URI = "/services/search/FindingService/v1"
+NAMESPACE = "{http://www.ebay.com/marketplace/search/v1/services}"
+
+# Paths of the fields kept from every item, relative to the item node
+ITEM_FIELDS = {'itemId': 'itemId',
+               'title': 'title',
+               'viewItemURL': 'viewItemURL',
+               'galleryURL': 'galleryURL',
+               'location': 'location',
+               'sellingStatus/convertedCurrentPrice': 'price',
+               'condition/conditionDisplayName': 'condition',
+               'listingInfo/startTime': 'startTime',
+               'listingInfo/bestOfferEnabled': 'bestOfferEnabled',
+               'shippingInfo/shippingServiceCost': 'shippingCost',
+               'shippingInfo/shippingType': 'shippingType',
+               'sellerInfo/sellerUserName': 'seller'}
+
+CHUNK_SIZE = 16384  # Bytes fed to the parser at a time
+ENTRIES_PER_PAGE = 100  # Largest page of a findItemsAdvanced request
+LIMIT_ERROR_ID = '10001'  # The call limit has been exceeded
+
+# Number of latency samples kept per site to calculate percentiles
+LATENCY_SAMPLES = 1000
+
+settings = {"domain": "svcs.ebay.com", "appid": None, "version": None,
+            "timeout": 20, "connect_timeout": 5, "pool_size": 10,
+            "keepalive": 60, "https": True}
+
+sessions = {}
+slots = {}  # Semaphores of the connections of every site
+stats = {}
+
+
+class FindingError(Exception):
+    """Raised when the Finding API answers with an error or a failure ack"""
+
+    def __init__(self, message, status=None, error_ids=()):
+        super(FindingError, self).__init__(message)
+        self.status = status
+        self.error_ids = list(error_ids)
+
+
+def dict_to_xml(data):
+    """Converts the request dictionary to the XML format expected by the
+    Finding API. Lists are turned into repeated nodes.
+
+    Example: {'itemFilter': [{'name': 'MinPrice', 'value': '10'}]}
+    Result: <itemFilter><name>MinPrice</name><value>10</value></itemFilter>
+    """
+    xml = ""
+    for key, value in data.items():
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            if isinstance(v, dict):
+                xml += f"<{key}>{dict_to_xml(v)}</{key}>"
+            else:
+                xml += f"<{key}>{escape(str(v))}</{key}>"
+    return xml
+
+
+def build_request_data(verb, data):
+    """Returns the XML body of the request for the given verb"""
+    xml = "<?xml version='1.0' encoding='utf-8'?>"
+    xml += f"<{verb}Request xmlns=\"{NAMESPACE[1:-1]}\">"
+    xml += dict_to_xml(data)
+    xml += f"</{verb}Request>"
+    return xml.encode('utf-8')
+
+
+def build_request_headers(verb, site_id):
+    """Returns the headers of the request for the given verb and site"""
+    return {"X-EBAY-SOA-SERVICE-VERSION": settings.get("version") or "",
+            "X-EBAY-SOA-SECURITY-APPNAME": settings.get("appid") or "",
+            "X-EBAY-SOA-GLOBAL-ID": site_id or "EBAY-US",
+            "X-EBAY-SOA-OPERATION-NAME": verb,
+            "X-EBAY-SOA-REQUEST-DATA-FORMAT": "XML",
+            "X-EBAY-SOA-RESPONSE-DATA-FORMAT": "XML",
+            "Content-Type": "text/xml",
+            "Accept-Encoding": "gzip"}
+
+
+def parse_items(body):
+    """Lazily parses the items of a findItemsAdvanced response.
+
+    The body is fed to a pull parser in chunks and every item is yielded as
+    soon as its closing tag is read, so the rest of the body is never parsed
+    if the caller stops iterating. Only the fields in ITEM_FIELDS are kept.
+
+    Example item: {'itemId': '1234', 'title': 'Selected Ambient Works CD',
+                   'price': '9.99', 'startTime': '2020-08-01T12:00:00.000Z',
+                   ...}
+
+    Raises FindingError at the end of the body if the API did not
+    acknowledge the request.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    path = []
+    item = None
+    ack = None
+    errors = []
+
+    for offset in range(0, len(body), CHUNK_SIZE):
+        parser.feed(body[offset:offset+CHUNK_SIZE])
+        for event, element in parser.read_events():
+            tag = element.tag.rpartition('}')[2]
+            if event == 'start':
+                path.append(tag)
+                if path[1:] == ['searchResult', 'item']:
+                    item = {}
+                continue
+
+            path.pop()
+            if item is not None:
+                if len(path) == 2:
+                    yield item
+                    item = None
+                    element.clear()
+                else:
+                    field = ITEM_FIELDS.get('/'.join(path[3:] + [tag]))
+                    if field:
+                        item[field] = element.text
+            elif tag == 'ack' and len(path) == 1:
+                ack = element.text
+            elif tag == 'error':
+                errors.append((element.findtext(f"{NAMESPACE}errorId"),
+                               element.findtext(f"{NAMESPACE}message")))
+    parser.close()
+
+    if ack not in ('Success', 'Warning'):
+        raise FindingError(
+            f"Finding API returned {ack}: "
+            f"{', '.join(message or '' for _, message in errors)}",
+            error_ids=[error_id for error_id, _ in errors])
+
+
+def parse_errors(body):
+    """Returns the IDs and messages of the errors in a failed response"""
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        return []
+    return [(e.findtext(f"{NAMESPACE}errorId"), e.findtext(f"{NAMESPACE}message"))
+            for e in root.iter(f"{NAMESPACE}error")]
+
+
+def get_site_stats(site_id):
+    """Returns the connection pool counters of the given site"""
+    if site_id not in stats:
+        stats[site_id] = {"calls": 0, "hits": 0, "misses": 0, "handshakes": 0,
+                          "bytes": 0, "latencies": deque(maxlen=LATENCY_SAMPLES)}
+    return stats[site_id]
+
+
+def get_trace_config(site_id):
+    """Returns an aiohttp TraceConfig that counts pool hits, misses and
+    handshakes for the given site"""
+    site_stats = get_site_stats(site_id)
+
+    async def on_reuse(session, context, params):
+        site_stats["hits"] += 1
+
+    async def on_create_start(session, context, params):
+        site_stats["misses"] += 1
+
+    async def on_create_end(session, context, params):
+        site_stats["handshakes"] += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_reuseconn.append(on_reuse)
+    trace_config.on_connection_create_start.append(on_create_start)
+    trace_config.on_connection_create_end.append(on_create_end)
+    return trace_config
+
+
+def get_session(site_id):
+    """Returns the session of the given site, creating it if needed.
+    Must be called from within the event loop."""
+    session = sessions.get(site_id)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=settings.get("pool_size"),
+                                         keepalive_timeout=settings.get("keepalive"))
+        timeout = aiohttp.ClientTimeout(total=settings.get("timeout"),
+                                        connect=settings.get("connect_timeout"))
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                        auto_decompress=True,
+                                        trace_configs=[get_trace_config(site_id)])
+        sessions[site_id] = session
+    return session
+
+
+def get_slots(site_id):
+    """Returns the semaphore of the site's connections, creating it if
+    needed. aiohttp lets new requests take a released connection before
+    the ones waiting for it, which then time out while connecting, so
+    requests queue here instead."""
+    semaphore = slots.get(site_id)
+    if semaphore is None:
+        semaphore = slots[site_id] = asyncio.Semaphore(settings.get("pool_size"))
+    return semaphore
+
+
+async def execute(verb, data, site_id):
+    """Sends a request to the Finding API and returns the parsed response
+
+    Keyword Arguments:
+        verb               -- API call name. Example: findItemsAdvanced
+        data               -- request dictionary
+        site_id            -- ebay site Global ID. Example: EBAY-US
+
+    Return Value:
+    Raw body of the response. Use parse_items to get its items.
+    """
+    scheme = "https" if settings.get("https") else "http"
+    url = f"{scheme}://{settings.get('domain')}{URI}"
+    async with get_slots(site_id):
+        start = time.perf_counter()
+        try:
+            async with get_session(site_id).post(url, data=build_request_data(verb, data),
+                                                 headers=build_request_headers(verb, site_id)) as res:
+                body = await res.read()
+                status = res.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            usage.record(error=True)
+            raise
+
+    site_stats = get_site_stats(site_id)
+    site_stats["calls"] += 1
+    site_stats["bytes"] += len(body)
+    site_stats["latencies"].append(time.perf_counter() - start)
+
+    if status != 200 or b"<ack>Failure</ack>" in body[:1024]:
+        errors = parse_errors(body)
+        error_ids = [error_id for error_id, _ in errors]
+        usage.record(error=True, limit_error=LIMIT_ERROR_ID in error_ids)
+        raise FindingError(
+            f"Finding API returned HTTP {status}: "
+            f"{', '.join(message or '' for _, message in errors)}",
+            status=status, error_ids=error_ids)
+
+    usage.record()
+    return body
+
+
+def get_pool_stats():
+    """Returns the connection pool counters and the median call latency
+    in milliseconds of every site
+
+    Example: {'EBAY-US': {'hits': 950, 'misses': 10, 'handshakes': 10,
+                          'p50': 143.2, 'calls': 960, 'bytes': 4200000}}
+    """
+    result = {}
+    for site_id, site_stats in stats.items():
+        latencies = site_stats["latencies"]
+        result[site_id] = {"hits": site_stats["hits"],
+                           "misses": site_stats["misses"],
+                           "handshakes": site_stats["handshakes"],
+                           "calls": site_stats["calls"],
+                           "bytes": site_stats["bytes"],
+                           "p50": statistics.median(latencies)*1000 if latencies else 0}
+    return result
+
+
+async def close():
+    """Closes the sessions of every site"""
+    for session in sessions.values():
+        await session.close()
+    sessions.clear()
+    slots.clear()
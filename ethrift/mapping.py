@@ -1,5 +1,7 @@
 """Maps values from ebay urls to FindItemsAdvanced accepted values."""
 
+MAX_LOCATED_IN = 25  # Countries allowed in a single LocatedIn filter
+
 EBAY_DOMAIN_TO_GLOBAL_ID = {'ebay.com': 'EBAY-US', 'ebay.ca': 'EBAY-ENCA',
                             'cafr.ebay.ca': 'EBAY-FRCA', 'ebay.co.uk': 'EBAY-GB',
                             'ebay.com.au': 'EBAY-AU', 'ebay.at': 'EBAY-AT',
@@ -179,10 +181,42 @@ def map_global_id_located_in(global_id, prefloc):
         prefloc                 -- Value for the filter in query string
 
     Return Value:
-    List of countries as ISO codes. Example: ['US', 'CA', 'MX]
+    List of countries as ISO codes for the LocatedIn filter, sent 25 at
+    a time, or None if no filter is sent. Example: ['US', 'CA', 'MX]
     """
-    aux = EBAY_GLOBAL_ID_LOCATED_IN.get(global_id)
-    return aux.get(int(prefloc[0]))
+    try:
+        return LOCATED_IN_PLANS.get((global_id, int(prefloc[0])))
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def get_located_in_plan(countries):
+    """Returns the cheapest LocatedIn filter equivalent to the given
+    countries
+
+    Lists covering every country are the same as sending no filter, so
+    they cost a single request instead of one per 25 countries. Lists of
+    the site's home country, or of any country group, are deduplicated and
+    sorted, so the item location values of a site that end up with the
+    same countries share their queries. Ebay has no filter excluding
+    countries, so the other lists are still sent 25 countries at a time.
+
+    Keyword Arguments:
+        countries               -- list of countries as ISO codes
+
+    Return Value:
+    List of countries for the LocatedIn filter or None.
+    Example: ['CA', 'MX', 'US']
+    """
+    if set(EBAY_COUNTRY_GROUPS['WORLDWIDE']).issubset(countries):
+        return None
+    return sorted(set(countries))
+
+
+# Request plans of every ebay website and item location value
+LOCATED_IN_PLANS = {(global_id, prefloc): get_located_in_plan(countries)
+                    for global_id, values in EBAY_GLOBAL_ID_LOCATED_IN.items()
+                    for prefloc, countries in values.items()}
 
 
 def map_ebay_query_to_listing_type(query):
@@ -0,0 +1,164 @@
+"""Include and exclude rules on the titles of the items of a search.
+
+The terms of every rule of every search are compiled into a single
+Aho-Corasick automaton, so every item title is scanned once to find all the
+terms it contains, no matter how many rules exist. Then every search only
+has to check its terms against the set of terms found.
+
+Terms are added to the trie as rules change and the failure links are
+recomputed in a single pass before the next scan. Removed terms are only
+unmarked, the trie is compacted once most of it is unused.
+"""
+
+
+class Rules:
+    """Terms an item title must contain, all of them, and terms it must
+    not contain, any of them"""
+    __slots__ = ('include', 'exclude')
+
+    def __init__(self, include=(), exclude=()):
+        self.include = frozenset(normalize(t) for t in include if normalize(t))
+        self.exclude = frozenset(normalize(t) for t in exclude if normalize(t))
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+
+    def get_terms(self):
+        """Returns every term of the rules"""
+        return self.include | self.exclude
+
+    def accepts(self, found):
+        """Returns whether the title the terms were found in passes the rules
+
+        Keyword Arguments:
+            found          -- set of terms found in the title by scan
+        """
+        return self.include <= found and not self.exclude & found
+
+
+class Automaton:
+    """Aho-Corasick automaton over the lowercase characters of the terms.
+
+    Nodes are indexes in parallel lists: goto holds the children of every
+    node, fail its failure link, term the term ending in it, if any, and out
+    the next node in its failure chain where a term ends.
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.term = [None]
+        self.out = [0]
+        self.counts = {}  # Number of rules using every term
+        self.dirty = False
+
+    def add(self, term):
+        """Adds a term, or one more use of a term already added"""
+        self.counts[term] = self.counts.get(term, 0) + 1
+        if self.counts[term] > 1:
+            return
+        node = 0
+        for char in term:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][char] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.term.append(None)
+                self.out.append(0)
+            node = child
+        self.term[node] = term
+        self.dirty = True
+
+    def remove(self, term):
+        """Removes one use of the term. The term stops being found once no
+        rules use it."""
+        count = self.counts.get(term, 0) - 1
+        if count > 0:
+            self.counts[term] = count
+            return
+        self.counts.pop(term, None)
+        if len(self.goto) > 64 and \
+           sum(len(t) for t in self.counts) * 2 < len(self.goto):
+            self.rebuild()
+
+    def rebuild(self):
+        """Builds the trie again with only the terms still in use"""
+        counts = self.counts
+        self.__init__()
+        for term, count in counts.items():
+            self.add(term)
+            self.counts[term] = count
+
+    def link(self):
+        """Computes the failure links of every node, breadth first"""
+        queue = list(self.goto[0].values())
+        for child in queue:
+            self.fail[child] = 0
+            self.out[child] = 0
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[child] = fail
+                self.out[child] = fail if self.term[fail] else self.out[fail]
+                queue.append(child)
+        self.dirty = False
+
+    def scan(self, text):
+        """Returns the set of terms found in the text as whole words"""
+        if self.dirty:
+            self.link()
+        text = normalize(text)
+        goto, fail, term, out = self.goto, self.fail, self.term, self.out
+        counts = self.counts
+        found = set()
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            match = node if term[node] else out[node]
+            while match:
+                t = term[match]
+                if t in counts and is_word(text, end + 1 - len(t), end + 1):
+                    found.add(t)
+                match = out[match]
+        return found
+
+
+def normalize(text):
+    """Returns the text in lowercase with single spaces between words"""
+    return " ".join(text.lower().split())
+
+
+def is_word(text, start, end):
+    """Returns whether the text between start and end is not part of a
+    longer word"""
+    return ((start == 0 or not text[start - 1].isalnum()
+             or not text[start].isalnum())
+            and (end == len(text) or not text[end].isalnum()
+                 or not text[end - 1].isalnum()))
+
+
+automaton = Automaton()
+
+
+def add_rules(rules):
+    """Adds the terms of the rules to the automaton"""
+    for term in rules.get_terms():
+        automaton.add(term)
+
+
+def remove_rules(rules):
+    """Removes the terms of the rules from the automaton"""
+    for term in rules.get_terms():
+        automaton.remove(term)
+
+
+def scan(title):
+    """Returns the set of rule terms found in the item title"""
+    return automaton.scan(title)
@@ -0,0 +1,168 @@
+"""Metrics of the polling and notification pipeline in the Prometheus text
+format, served over HTTP on a local port.
+
+Metrics are opt-in. When they are disabled, the only cost left in the
+pipeline is checking the enabled flag before recording anything.
+"""
+import bisect
+import time
+
+from collections import deque
+from datetime import datetime
+
+import ebay
+import circuit
+import finding
+import scheduler
+import dispatcher
+import usage
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)  # Seconds
+LAG_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 1800, 3600)  # Seconds
+
+settings = {"enabled": False, "host": "127.0.0.1", "port": 9090}
+
+enabled = False
+runner = None
+latencies = {}
+calls = {}
+call_times = deque()
+errors = {}
+item_lag = None
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_lines(self, name, labels=""):
+        """Returns the histogram in the Prometheus text format"""
+        separator = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bucket}"}} '
+                         f'{cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+def observe_call(site_id, latency):
+    """Records a Finding API call and its latency in seconds"""
+    histogram = latencies.get(site_id)
+    if histogram is None:
+        histogram = latencies[site_id] = Histogram(LATENCY_BUCKETS)
+    histogram.observe(latency)
+    calls[site_id] = calls.get(site_id, 0) + 1
+    call_times.append(time.monotonic())
+    prune_call_times()
+
+
+def prune_call_times():
+    """Drops the calls made more than a minute ago"""
+    now = time.monotonic()
+    while call_times and call_times[0] < now - 60:
+        call_times.popleft()
+
+
+def count_error(kind):
+    """Counts an error of the given type. Example: timeout"""
+    errors[kind] = errors.get(kind, 0) + 1
+
+
+def observe_sent(start_time):
+    """Records the time between an item being listed and being sent
+
+    Keyword Arguments:
+        start_time         -- UTC datetime the item was listed at
+    """
+    if start_time is not None:
+        item_lag.observe((datetime.utcnow() - start_time).total_seconds())
+
+
+def get_text():
+    """Returns every metric in the Prometheus text format"""
+    lines = ["# TYPE ethrift_finding_call_seconds histogram"]
+    for site_id, histogram in latencies.items():
+        lines += histogram.get_lines("ethrift_finding_call_seconds",
+                                     f'site="{site_id}"')
+
+    lines.append("# TYPE ethrift_finding_calls_total counter")
+    lines += [f'ethrift_finding_calls_total{{site="{site_id}"}} {count}'
+              for site_id, count in calls.items()]
+    lines.append("# TYPE ethrift_finding_response_bytes_total counter")
+    lines += [f'ethrift_finding_response_bytes_total{{site="{site_id}"}} '
+              f'{site_stats["bytes"]}'
+              for site_id, site_stats in finding.stats.items()]
+    lines.append("# TYPE ethrift_finding_calls_per_minute gauge")
+    prune_call_times()
+    lines.append(f"ethrift_finding_calls_per_minute {len(call_times)}")
+    lines.append("# TYPE ethrift_finding_calls_remaining gauge")
+    lines.append(f"ethrift_finding_calls_remaining {usage.get_remaining()}")
+
+    lines.append("# TYPE ethrift_errors_total counter")
+    lines += [f'ethrift_errors_total{{type="{kind}"}} {count}'
+              for kind, count in errors.items()]
+
+    lines.append("# TYPE ethrift_site_paused gauge")
+    lines += [f'ethrift_site_paused{{site="{site_id}"}} '
+              f'{int(breaker.state != circuit.CLOSED)}'
+              for site_id, breaker in circuit.breakers.items()]
+
+    lines.append("# TYPE ethrift_fetch_queue_depth gauge")
+    lines.append(f"ethrift_fetch_queue_depth "
+                 f"{ebay.queue.qsize() if ebay.queue else 0}")
+    lines.append("# TYPE ethrift_scheduled_batches gauge")
+    lines.append(f"ethrift_scheduled_batches {len(ebay.batch_list)}")
+    lines.append("# TYPE ethrift_planned_calls_per_second gauge")
+    lines.append(f"ethrift_planned_calls_per_second "
+                 f"{scheduler.get_calls_per_second()}")
+
+    lines.append("# TYPE ethrift_channel_backlog gauge")
+    lines += [f'ethrift_channel_backlog{{channel="{channel_id}"}} '
+              f'{len(channel.queue)}'
+              for channel_id, channel in dispatcher.channels.items()
+              if channel.queue]
+
+    lines.append("# TYPE ethrift_item_lag_seconds histogram")
+    lines += item_lag.get_lines("ethrift_item_lag_seconds")
+    return "\n".join(lines) + "\n"
+
+
+async def handle(request):
+    from aiohttp import web
+    return web.Response(text=get_text(), content_type="text/plain")
+
+
+async def start():
+    """Starts serving the metrics, if enabled in the settings.
+    Must be called from the event loop."""
+    global enabled, runner, item_lag
+    if not settings["enabled"] or runner:
+        return
+    from aiohttp import web  # Only needed when the metrics are served
+    item_lag = Histogram(LAG_BUCKETS)
+    enabled = True
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, settings["host"], settings["port"]).start()
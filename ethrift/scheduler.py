@@ -0,0 +1,171 @@
+"""Deadline based scheduler of the batches of queries.
+
+Every batch is polled at its own interval, kept in a heap ordered by the
+time the batch is due. Intervals are allocated from the daily call budget
+according to the rate at which each batch gets new items:
+
+    interval = S * sqrt(cost / rate)
+
+which minimizes the average delay of new items for a given number of calls.
+S is chosen so that all intervals together use the whole budget, so active
+searches are polled faster and dead ones slower. The budget is what is left
+in today's call bucket spread over the time left until it is refilled, so
+intervals grow as the bucket drains faster than planned and polling stops
+when it is empty. The batches of an ebay site whose circuit breaker is open
+are held back until the site recovers, without delaying the other sites.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import random
+import time
+
+import ebay
+import usage
+import tracing
+import circuit
+import bot
+
+
+MIN_INTERVAL = 30  # Seconds
+MAX_INTERVAL_FACTOR = 8  # Times the interval every batch would get without adapting
+REBALANCE_INTERVAL = 60  # Seconds between interval allocations
+RATE_ALPHA = 0.2  # Weight of the newest observation in a query's average rate
+PRIOR_RATE = 1 / 86400  # New items per second assumed for quiet queries
+
+heap = []
+counter = itertools.count()
+wake = None
+task = None
+rebalanced_at = 0
+
+
+def push(batch, deadline):
+    """Puts the batch in the heap to be polled at the given deadline.
+    Older heap entries of the batch are ignored when popped."""
+    batch.deadline = deadline
+    heapq.heappush(heap, (deadline, next(counter), batch))
+
+
+def add(batch):
+    """Schedules a new batch. The first poll is spread over its interval
+    so batches added at the same time are not all polled together."""
+    global rebalanced_at
+    if task is None:
+        return
+    batch.interval = batch.interval or bot.get_items_interval()
+    push(batch, time.monotonic() + random.uniform(0, batch.interval))
+    rebalanced_at = 0
+    wake.set()
+
+
+def defer(batch, delay):
+    """Polls the batch again after the given seconds instead of at the end
+    of its interval. Used by batches that have more pages to fetch."""
+    push(batch, time.monotonic() + delay)
+    if wake is not None:
+        wake.set()
+
+
+def observe(query, new_items):
+    """Updates the query's average rate of new items per second after it
+    was polled"""
+    now = time.monotonic()
+    if query.polled_at is not None and now > query.polled_at:
+        rate = new_items / (now - query.polled_at)
+        query.rate = RATE_ALPHA * rate + (1 - RATE_ALPHA) * query.rate
+    query.polled_at = now
+
+
+def get_rate(batch):
+    """Returns the rate of new items per second of the batch"""
+    return sum(max(q.rate, PRIOR_RATE) for q in batch.queries)
+
+
+def rebalance():
+    """Allocates an interval to every batch from the daily call budget"""
+    global rebalanced_at
+    rebalanced_at = time.monotonic()
+    batches = [b for b in ebay.batch_list if b.queries]
+    if not batches:
+        return
+
+    calls_per_second = usage.get_remaining() / usage.get_seconds_to_reset()
+    max_interval = MAX_INTERVAL_FACTOR * bot.get_items_interval()
+    intervals = {}
+    fixed = {}
+
+    # Clamped batches use less than their share of the budget, so the
+    # allocation is repeated with what is left for the other batches
+    for _ in range(3):
+        free = [b for b in batches if b not in fixed]
+        budget = calls_per_second - sum(b.get_cost() / i
+                                        for b, i in fixed.items())
+        if not free or budget <= 0:
+            break
+        scale = sum(math.sqrt(b.get_cost() * get_rate(b))
+                    for b in free) / budget
+        clamped = False
+        for batch in free:
+            interval = scale * math.sqrt(batch.get_cost() / get_rate(batch))
+            if not MIN_INTERVAL <= interval <= max_interval:
+                fixed[batch] = min(max(interval, MIN_INTERVAL), max_interval)
+                clamped = True
+            intervals[batch] = interval
+        if not clamped:
+            break
+
+    for batch in batches:
+        batch.interval = fixed.get(batch, intervals.get(batch, max_interval))
+        # Batches due later than their new interval allows are moved forward
+        if batch.polled_at is not None \
+           and batch.polled_at + batch.interval < batch.deadline:
+            push(batch, batch.polled_at + batch.interval)
+
+
+async def run():
+    """Puts every batch in the fetch queue when it is due"""
+    while True:
+        if time.monotonic() - rebalanced_at > REBALANCE_INTERVAL:
+            rebalance()
+
+        now = time.monotonic()
+        with tracing.span("schedule", heap=len(heap)):
+            while heap and heap[0][0] <= now and usage.get_remaining() > 0:
+                deadline, _, batch = heapq.heappop(heap)
+                if deadline != batch.deadline or not batch.queries:
+                    continue  # Rescheduled or removed batch
+                paused_until = circuit.get_paused_until(batch.ebay_site)
+                if paused_until is not None:
+                    push(batch, paused_until)  # Held back until the site recovers
+                    continue
+                batch.polled_at = now
+                push(batch, now + batch.interval)
+                ebay.Search.enqueue(batch)
+
+        timeout = heap[0][0] - now if heap else REBALANCE_INTERVAL
+        if usage.get_remaining() <= 0:
+            timeout = usage.get_seconds_to_reset()
+        wake.clear()
+        try:
+            await asyncio.wait_for(wake.wait(),
+                                   min(timeout, REBALANCE_INTERVAL))
+        except asyncio.TimeoutError:
+            pass
+
+
+def get_calls_per_second():
+    """Returns the rate of calls currently planned for all batches"""
+    return sum(b.get_cost() / b.interval for b in ebay.batch_list
+               if b.queries and b.interval)
+
+
+def start():
+    """Schedules every batch and starts the scheduler task.
+    Must be called from the event loop."""
+    global task, wake
+    wake = asyncio.Event()
+    task = asyncio.ensure_future(run())
+    for batch in ebay.batch_list:
+        add(batch)
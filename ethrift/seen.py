@@ -0,0 +1,47 @@
+"""IDs of the items a query has already seen in its newest second."""
+
+
+class SeenItems:
+    """IDs of the items seen by a query that were listed in the same second
+    as its newest start time.
+
+    Requests start at the newest start time seen, so only the items listed
+    in that second are returned again by the next request. Older items
+    are never returned again and newer ones can't have been seen, so the
+    IDs are dropped as soon as the newest start time moves on.
+    Numeric item IDs are stored as ints in a tuple, which take less memory
+    than the strings returned by the API, and most queries share the
+    empty tuple.
+    """
+    __slots__ = ('ids',)
+
+    def __init__(self):
+        self.ids = ()
+
+    def __contains__(self, item_id):
+        return SeenItems.to_key(item_id) in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        """Iterates through the seen IDs as strings"""
+        return (f"{key}" for key in self.ids)
+
+    def add(self, item_ids):
+        """Marks the items, listed in the newest second, as seen"""
+        self.ids += tuple(SeenItems.to_key(i) for i in item_ids
+                          if SeenItems.to_key(i) not in self.ids)
+
+    def move(self, item_ids):
+        """Replaces the seen items with the items listed in the new newest
+        second"""
+        self.ids = tuple(SeenItems.to_key(i) for i in item_ids)
+
+    @staticmethod
+    def to_key(item_id):
+        """Returns the item ID as an int if possible"""
+        try:
+            return int(item_id)
+        except (TypeError, ValueError):
+            return item_id
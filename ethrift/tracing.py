@@ -0,0 +1,111 @@
+"""Opt-in tracing of the polling cycles.
+
+Spans of the steps of every cycle, from the scheduler to the messages sent
+to Discord, are kept in a ring buffer and can be dumped as Chrome trace
+events, to be opened in chrome://tracing or https://ui.perfetto.dev.
+Every fetch worker and channel queue shows as its own track.
+When tracing is disabled, spans cost a single function call.
+"""
+import asyncio
+import json
+import os
+import time
+
+from collections import deque
+
+
+MAX_TRACKS = 1000  # Tracks are numbered again from 1 after this many
+
+settings = {"enabled": False, "size": 20000}
+
+enabled = False
+spans = deque(maxlen=settings["size"])
+tracks = {}
+
+
+class Span:
+    """Context manager timing a step of the cycle"""
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        spans.append((self.name, self.start, end - self.start,
+                      get_track(), self.args))
+        return False
+
+
+class NullSpan:
+    """Span used while tracing is disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, **args):
+    """Returns a context manager recording a span with the given name and
+    arguments. Example: with tracing.span("finding", site="EBAY-US"): ..."""
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, args)
+
+
+def get_track():
+    """Returns the number of the track of the current task"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    key = id(task)
+    track = tracks.get(key)
+    if track is None:
+        if len(tracks) >= MAX_TRACKS:
+            tracks.clear()
+        track = tracks[key] = len(tracks) + 1
+    return track
+
+
+def start(size=None):
+    """Starts recording spans, keeping the given number of newest spans"""
+    global enabled, spans
+    if size and size != spans.maxlen:
+        spans = deque(spans, maxlen=size)
+    enabled = True
+
+
+def stop():
+    """Stops recording spans. The recorded spans are kept."""
+    global enabled
+    enabled = False
+
+
+def get_trace():
+    """Returns the recorded spans in the Chrome trace event format"""
+    events = [{"name": name, "ph": "X", "pid": os.getpid(), "tid": track,
+               "ts": round(start * 10**6), "dur": round(duration * 10**6),
+               "args": args}
+              for name, start, duration, track, args in list(spans)]
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def dump(path):
+    """Writes the recorded spans to the given file as Chrome trace JSON"""
+    with open(path, "w") as file:
+        json.dump(get_trace(), file, default=str)
+    return len(spans)
@@ -0,0 +1,110 @@
+"""Accounting of the Finding API calls made every day.
+
+Every request is counted, including failed ones, since eBay counts them
+against the daily call limit too. The remaining calls of the day work as
+a token bucket that is refilled when eBay resets the limits, at midnight
+Pacific time. The counters are saved to a file so they survive restarts.
+"""
+import json
+import time
+
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import utils
+
+
+RESET_TIMEZONE = ZoneInfo("America/Los_Angeles")
+SAVE_INTERVAL = 30  # Seconds between saves of the counters
+
+settings = {"max_calls": 5000, "path": "../usage.json"}
+
+counters = {"day": None, "calls": 0, "errors": 0, "limit_errors": 0}
+saved_at = 0
+
+
+def get_day():
+    """Returns the current eBay day as an ISO date string"""
+    return datetime.now(RESET_TIMEZONE).date().isoformat()
+
+
+def get_seconds_to_reset():
+    """Returns the seconds left until the daily call limit is reset"""
+    now = datetime.now(RESET_TIMEZONE)
+    midnight = datetime.combine(now.date() + timedelta(days=1),
+                                datetime.min.time(), RESET_TIMEZONE)
+    return max((midnight - now).total_seconds(), 1)
+
+
+def check_day():
+    """Resets the counters when a new eBay day starts"""
+    day = get_day()
+    if counters["day"] != day:
+        counters.update(day=day, calls=0, errors=0, limit_errors=0)
+        save()
+
+
+def record(error=False, limit_error=False):
+    """Counts a call to the Finding API
+
+    Keyword Arguments:
+        error              -- whether the call failed
+        limit_error        -- whether the call failed because the call
+                              limit was exceeded
+    """
+    check_day()
+    counters["calls"] += 1
+    counters["errors"] += 1 if error or limit_error else 0
+    counters["limit_errors"] += 1 if limit_error else 0
+    if time.monotonic() - saved_at > SAVE_INTERVAL:
+        save()
+
+
+def get_remaining():
+    """Returns the number of calls left in today's bucket"""
+    check_day()
+    return max(settings.get("max_calls") - counters["calls"], 0)
+
+
+def get_usage(calls_per_second):
+    """Returns the usage of the day
+
+    Keyword Arguments:
+        calls_per_second   -- rate of calls currently planned by the scheduler
+
+    Return Value:
+    Dictionary with the calls used, the calls projected by the end of the
+    day at the current rate and the headroom left.
+    Example: {'used': 1200, 'projected': 4800, 'headroom': 200,
+              'errors': 3, 'limit_errors': 0}
+    """
+    check_day()
+    projected = counters["calls"] + round(calls_per_second
+                                          * get_seconds_to_reset())
+    return {"used": counters["calls"],
+            "projected": projected,
+            "headroom": settings.get("max_calls") - projected,
+            "errors": counters["errors"],
+            "limit_errors": counters["limit_errors"]}
+
+
+def save():
+    """Saves the counters to the usage file"""
+    global saved_at
+    saved_at = time.monotonic()
+    try:
+        with open(utils.get_file_path(settings.get("path")), "w") as file:
+            json.dump(counters, file)
+    except OSError as exception:
+        print(f"Unable to save API usage\nException: {exception}")
+
+
+def load():
+    """Loads the counters saved today, if any"""
+    try:
+        with open(utils.get_file_path(settings.get("path"))) as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return
+    if saved.get("day") == get_day():
+        counters.update(saved)
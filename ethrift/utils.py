@@ -1,23 +1,8 @@
 import math
 import os
-import asyncio
 from datetime import datetime
 
 
-def async_from_sync(loop, function, *args, **kwargs):
-    """
-    Wrapper to allow calling async functions from sync
-    and running them in set event loop
-
-    Keyword Arguments:
-        loop               -- event loop to run function in
-        function           -- function to be ran
-        *args, **kwargs    -- arguments to be passed to the function
-    """
-    res = function(*args, **kwargs)
-    asyncio.run_coroutine_threadsafe(res, loop).result()
-
-
 def get_file_path(filename):
     """Receives a relative file path and returns the absolute one"""
     return os.path.join(os.path.dirname(__file__), filename)